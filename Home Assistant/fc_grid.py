@@ -0,0 +1,63 @@
+# fc_grid.py Free chlorine from the ORP-FC chart
+#
+# Free chlorine (ppm) by ORP (mV) and pH, from the ORP-FC chart as built by
+# Ph-ORP Chart/chart_loader.py.  fc_chart.bin goes next to this file; cells the
+# chart leaves blank (FC too high to matter) are NaN.  Shared by the pool_fc.py
+# AppDaemon app and Ph-ORP Chart/fc_backfill.py, so it needs only numpy and
+# reads nothing until FcGrid.load() is called.
+
+import os
+
+import numpy as np
+
+CHART = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fc_chart.bin')
+MAGIC = b'OFCG'
+HEADER = 16
+
+
+def _lerp(a, b, t):
+    return np.where(t == 0, a, np.where(t == 1, b, a * (1 - t) + b * t))
+
+
+class FcGrid:
+    """
+    The chart as sorted ORP and pH axes and a dense FC matrix, built once.
+    Lookups bisect both axes and interpolate bilinearly between the four
+    surrounding chart values.  Points off the chart, or next to a blank cell,
+    give NaN rather than a guess.
+    """
+    def __init__(self, orp, ph, table):
+        self.orp = np.asarray(orp, dtype=float)
+        self.ph = np.asarray(ph, dtype=float)
+        self.table = np.asarray(table, dtype=float)
+
+    @classmethod
+    def load(cls, path=CHART):
+        """The chart from a chart_loader.py artifact, in one read."""
+        with open(path, 'rb') as f:
+            head = f.read(HEADER)
+        if head[:5] != MAGIC + b'\x01':
+            raise ValueError('{} is not an FC chart'.format(path))
+        n_orp, n_ph = np.frombuffer(head, dtype='<u2', count=2, offset=6)
+        data = np.fromfile(path, dtype='<f4', offset=HEADER)
+        if len(data) != n_orp + n_ph + n_orp * n_ph:
+            raise ValueError('{} is truncated'.format(path))
+        return cls(data[:n_orp], data[n_orp:n_orp + n_ph], data[n_orp + n_ph:].reshape(n_orp, n_ph))
+
+    def lookup_many(self, ph, orp):
+        """FC for arrays (or scalars) of pH and ORP; returns an array of the broadcast shape."""
+        ph, orp = np.broadcast_arrays(np.asarray(ph, dtype=float), np.asarray(orp, dtype=float))
+        i = np.clip(np.searchsorted(self.orp, orp, side='right') - 1, 0, len(self.orp) - 2)
+        j = np.clip(np.searchsorted(self.ph, ph, side='right') - 1, 0, len(self.ph) - 2)
+        tx = (orp - self.orp[i]) / (self.orp[i + 1] - self.orp[i])
+        ty = (ph - self.ph[j]) / (self.ph[j + 1] - self.ph[j])
+        t = self.table
+        lo = _lerp(t[i, j], t[i, j + 1], ty)
+        hi = _lerp(t[i + 1, j], t[i + 1, j + 1], ty)
+        fc = _lerp(lo, hi, tx)
+        outside = ((orp < self.orp[0]) | (orp > self.orp[-1])
+                   | (ph < self.ph[0]) | (ph > self.ph[-1]))
+        return np.where(outside, np.nan, fc)
+
+    def lookup(self, ph, orp):
+        return float(self.lookup_many(ph, orp))
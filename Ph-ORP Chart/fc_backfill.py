@@ -0,0 +1,208 @@
+# fc_backfill.py Free chlorine for recorded pH and ORP history
+#
+# Reads the pH and ORP history of a Home Assistant install, either a history
+# CSV download (entity_id, state, last_changed) or the recorder database
+# itself (home-assistant_v2.db), and writes FC by the ORP-FC chart for every
+# reading of one series, paired with the latest reading of the other at or
+# before it (an as-of join).  Both series are streamed in time order, a chunk
+# at a time, and FC is looked up for a whole chunk at once, so memory stays the
+# same however much history there is.  A reading is paired only with a partner
+# at most --tolerance seconds older; otherwise, or off the chart, FC is blank.
+#
+#   python3 fc_backfill.py history.csv -o fc.csv
+#   python3 fc_backfill.py home-assistant_v2.db -o fc.parquet    # needs pyarrow
+#
+# Needs numpy; Parquet output also needs pyarrow.  FC is looked up with
+# Home Assistant/fc_grid.py, as the AppDaemon app does, so it matches what
+# the app reports.
+
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Home Assistant'))
+from fc_grid import CHART, FcGrid  # the same lookup as the AppDaemon app
+
+CHUNK = 65536
+
+
+def _number(state):  # NaN while the sensor was unavailable
+    try:
+        return float(state)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _chunks(rows, chunk):  # (unix times, values) arrays from (time, state) rows in time order
+    t, v = [], []
+    for ts, state in rows:
+        t.append(ts)
+        v.append(_number(state))
+        if len(t) == chunk:
+            yield np.array(t), np.array(v)
+            t, v = [], []
+    if t:
+        yield np.array(t), np.array(v)
+
+
+def _timestamp(text):
+    dt = datetime.fromisoformat(text.strip().replace('Z', '+00:00').replace(' ', 'T'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)  # the recorder keeps UTC
+    return dt.timestamp()
+
+
+def csv_series(path, entity, chunk):
+    """One entity's history from a history CSV download, in time order."""
+    def rows():
+        with open(path, 'rt', newline='') as f:
+            reader = csv.DictReader(f)
+            when = 'last_changed' if 'last_changed' in reader.fieldnames else 'last_updated'
+            last = None
+            for row in reader:
+                if row['entity_id'] == entity:
+                    ts = _timestamp(row[when])
+                    if last is not None and ts < last:
+                        raise ValueError('{}: {} is not in time order'.format(path, entity))
+                    last = ts
+                    yield ts, row['state']
+    return _chunks(rows(), chunk)
+
+
+def sqlite_series(path, entity, chunk):
+    """One entity's history from the recorder database, in time order."""
+    db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    columns = {row[1] for row in db.execute('PRAGMA table_info(states)')}
+    if 'metadata_id' in columns and 'last_updated_ts' in columns:  # recorder schema 2023.4 and later
+        cur = db.execute('SELECT s.last_updated_ts, s.state FROM states s JOIN states_meta m'
+                         ' ON s.metadata_id = m.metadata_id WHERE m.entity_id = ? ORDER BY s.last_updated_ts',
+                         (entity,))
+        convert = float
+    else:
+        cur = db.execute('SELECT last_updated, state FROM states WHERE entity_id = ? ORDER BY last_updated',
+                         (entity,))
+        convert = _timestamp
+
+    def rows():
+        try:
+            while True:
+                batch = cur.fetchmany(chunk)
+                if not batch:
+                    return
+                for ts, state in batch:
+                    yield convert(ts), state
+        finally:
+            db.close()
+    return _chunks(rows(), chunk)
+
+
+def asof_join(left, right, tolerance):
+    """
+    (times, left values, right values) chunks, one row per left reading, with the
+    latest right value at or before it and no more than tolerance seconds old
+    (NaN otherwise).  Holds at most one left chunk and two right chunks.
+    """
+    rt, rv = np.array([-np.inf]), np.array([np.nan])  # always starts with the last right reading seen
+    lt, lv = np.empty(0), np.empty(0)
+    right_done = False
+    while True:
+        if not len(lt):
+            lt, lv = next(left, (None, None))
+            if lt is None:
+                return
+        if not right_done and rt[-1] <= lt[-1]:
+            keep = np.searchsorted(rt, lt[0], side='right') - 1  # older readings can never match again
+            rt, rv = rt[keep:], rv[keep:]
+            more = next(right, None)
+            if more is None:
+                right_done = True
+            else:
+                rt, rv = np.concatenate((rt, more[0])), np.concatenate((rv, more[1]))
+        # left readings older than the newest right one (or all, at the end) are settled
+        n = len(lt) if right_done else np.searchsorted(lt, rt[-1], side='left')
+        if not n:
+            continue
+        t, v = lt[:n], lv[:n]
+        lt, lv = lt[n:], lv[n:]
+        k = np.searchsorted(rt, t, side='right') - 1
+        yield t, v, np.where(t - rt[k] <= tolerance, rv[k], np.nan)
+
+
+class CsvOut:
+    def __init__(self, path):
+        self.f = open(path, 'wt', newline='')
+        self.w = csv.writer(self.f)
+        self.w.writerow(('time', 'ph', 'orp', 'fc'))
+
+    def write(self, t, ph, orp, fc):
+        when = np.datetime_as_string((t * 1000).astype('datetime64[ms]'), timezone='UTC')
+        cols = [['' if np.isnan(x) else '{:.{}f}'.format(x, d) for x in a] for a, d in ((ph, 3), (orp, 1), (fc, 2))]
+        self.w.writerows(zip(when, *cols))
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetOut:  # one row group per chunk
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit('Parquet output needs pyarrow (pip install pyarrow)')
+        self.pa = pa
+        self.schema = pa.schema([('time', pa.timestamp('ms', tz='UTC')), ('ph', pa.float64()),
+                                 ('orp', pa.float64()), ('fc', pa.float64())])
+        self.w = pq.ParquetWriter(path, self.schema)
+
+    def write(self, t, ph, orp, fc):
+        pa = self.pa
+        cols = [pa.array((t * 1000).astype('int64'), pa.int64()).cast(self.schema.field('time').type)]
+        cols += [pa.array(a, from_pandas=True) for a in (ph, orp, fc)]  # NaN becomes null
+        self.w.write_table(pa.Table.from_arrays(cols, schema=self.schema))
+
+    def close(self):
+        self.w.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Compute free chlorine for recorded pH and ORP history')
+    ap.add_argument('input', help='history CSV download or recorder database (home-assistant_v2.db)')
+    ap.add_argument('-o', '--output', required=True, help='.csv or .parquet file to write')
+    ap.add_argument('--ph', default='sensor.pool_ph', help='pH entity (default: %(default)s)')
+    ap.add_argument('--orp', default='sensor.pool_orp', help='ORP entity (default: %(default)s)')
+    ap.add_argument('--by', choices=('orp', 'ph'), default='orp', help='series that gives one row per reading')
+    ap.add_argument('--tolerance', type=float, default=300, help='oldest partner reading to pair with (s)')
+    ap.add_argument('--chart', default=CHART, help='chart built by chart_loader.py (default: %(default)s)')
+    ap.add_argument('--chunk', type=int, default=CHUNK, help='readings per chunk')
+    args = ap.parse_args()
+    try:
+        grid = FcGrid.load(args.chart)
+    except (OSError, ValueError) as e:
+        sys.exit(str(e))
+    with open(args.input, 'rb') as f:
+        source = sqlite_series if f.read(16) == b'SQLite format 3\x00' else csv_series
+    ph = source(args.input, args.ph, args.chunk)
+    orp = source(args.input, args.orp, args.chunk)
+    out = ParquetOut(args.output) if os.path.splitext(args.output)[1] == '.parquet' else CsvOut(args.output)
+    rows = paired = charted = 0
+    try:
+        for t, a, b in asof_join(orp, ph, args.tolerance) if args.by == 'orp' else asof_join(ph, orp, args.tolerance):
+            ph_v, orp_v = (b, a) if args.by == 'orp' else (a, b)
+            fc = grid.lookup_many(ph_v, orp_v)
+            out.write(t, ph_v, orp_v, fc)
+            rows += len(t)
+            paired += int(np.count_nonzero(~np.isnan(ph_v) & ~np.isnan(orp_v)))
+            charted += int(np.count_nonzero(~np.isnan(fc)))
+    finally:
+        out.close()
+    print('{} rows, {} paired, {} on the chart'.format(rows, paired, charted), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
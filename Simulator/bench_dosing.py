@@ -0,0 +1,181 @@
+# bench_dosing.py Settling time and overshoot of the on-device dosing controller
+# Released under the MIT licence.
+
+# Runs dosing.py's PID against a model of a 50 m3 pool, starting from a pool
+# that needs work (pH 7.9, 0.5 ppm free chlorine), and compares it with the
+# open loop style of control a Home Assistant automation gives: a fixed pulse
+# whenever the reading is outside the deadband.
+#
+# The model, per pump second at 1.5 l/h:
+#   acid     31% muriatic acid lowers pH by 8e-5, against an upward drift of
+#            0.1 pH per day from aeration
+#   bleach   12.5% hypochlorite adds 1.05e-3 ppm free chlorine, which decays
+#            at 60% per day
+#   mixing   a dose reaches the probe with a 30 minute time constant
+#   ORP      700 + 170 log10(FC / 1.1) - 50 (pH - 7.5) mV, a fit to the
+#            ORP-FC chart between 0.5 and 4 ppm
+#   probes   EZO noise of 0.01 pH and 2 mV, averaged as the firmware does
+#
+# Reported per channel: settling time (until the true value stays within the
+# deadband of the setpoint), overshoot past the setpoint, chemical used and
+# the spread over the last day.
+#
+#   python3 Simulator/bench_dosing.py --days 3 --conf ph_ki=0.05
+
+import argparse
+import math
+import random
+
+import shims
+
+shims.install()
+from dosing import PID, Doser, RAISES, LOWERS
+from rolling import RollingStats
+
+PUMP_ML_PER_S = 1500 / 3600
+ACID_PH_PER_S = 8e-5
+PH_DRIFT_PER_S = 0.1 / 86400
+BLEACH_PPM_PER_S = 1.05e-3
+FC_DECAY_PER_S = 0.6 / 86400
+MIX_TAU = 1800.0
+
+# conf.txt settings and their defaults, as in config.py
+CONF = {
+    'dosing_interval': 600,
+    'ph_setpoint': 7.4, 'ph_kp': 1000.0, 'ph_ki': 0.01, 'ph_kd': 0.0,
+    'ph_deadband': 0.05, 'ph_max_pulse': 180,
+    'orp_setpoint': 700.0, 'orp_kp': 2.0, 'orp_ki': 0.00005, 'orp_kd': 0.0,
+    'orp_deadband': 10.0, 'orp_max_pulse': 180,
+    'report_interval': 5, 'ph_ma_window': 10, 'orp_ma_window': 10,
+}
+
+
+class Pool:
+    def __init__(self, ph=7.9, fc=0.5):
+        self.ph = ph
+        self.fc = fc
+        self.acid = 0.0  # dosed, not yet mixed in (pH units)
+        self.bleach = 0.0  # dosed, not yet mixed in (ppm)
+
+    @property
+    def orp(self):
+        return 700 + 170 * math.log10(max(self.fc, 0.01) / 1.1) - 50 * (self.ph - 7.5)
+
+    def step(self, dt, acid_on, bleach_on):
+        if acid_on:
+            self.acid += ACID_PH_PER_S * dt
+        if bleach_on:
+            self.bleach += BLEACH_PPM_PER_S * dt
+        k = 1 - math.exp(-dt / MIX_TAU)
+        self.ph += PH_DRIFT_PER_S * dt - self.acid * k
+        self.acid -= self.acid * k
+        self.fc += self.bleach * k - self.fc * FC_DECAY_PER_S * dt
+        self.bleach -= self.bleach * k
+
+
+class Pump:  # stands in for PumpScheduler on the simulated clock
+    def __init__(self):
+        self.until = 0.0
+        self.now = 0.0
+        self.seconds = 0.0
+
+    def request(self, seconds):
+        self.until = max(self.until, self.now + seconds)
+        return seconds
+
+    def on(self):
+        return self.now < self.until
+
+
+class OnOff:  # fixed pulse whenever the reading is outside the deadband
+    def __init__(self, setpoint, deadband, pulse, direction):
+        self.setpoint = setpoint
+        self.deadband = deadband
+        self.pulse = pulse
+        self.direction = direction
+        self.integral = 0.0
+
+    def reset(self):
+        pass
+
+    def update(self, value, dt):
+        return self.pulse if (self.setpoint - value) * self.direction >= self.deadband else 0
+
+
+def simulate(conf, controller, days, seed=1):
+    random.seed(seed)
+    pool = Pool()
+    channels = []
+    for key, direction, noise, read in (('ph', LOWERS, 0.01, lambda: pool.ph),
+                                        ('orp', RAISES, 2.0, lambda: pool.orp)):
+        sp, band = conf[key + '_setpoint'], conf[key + '_deadband']
+        if controller == 'pid':
+            ctl = PID(sp, conf[key + '_kp'], conf[key + '_ki'], conf[key + '_kd'], band,
+                      conf[key + '_max_pulse'], direction=direction)
+        else:
+            ctl = OnOff(sp, band, conf[key + '_max_pulse'], direction)
+        window = conf[key + '_ma_window']
+        stats = RollingStats(window)
+        pump = Pump()
+        channels.append({'key': key, 'direction': direction, 'noise': noise, 'read': read,
+                         'sp': sp, 'band': band, 'stats': stats, 'pump': pump,
+                         'doser': Doser(ctl, stats, pump, conf['dosing_interval'], window),
+                         'trace': []})
+    dt = conf['report_interval']
+    steps = int(days * 86400 / dt)
+    every = conf['dosing_interval'] // dt
+    for i in range(steps):
+        t = i * dt
+        for c in channels:
+            c['pump'].now = t
+            c['stats'].add(c['read']() + random.gauss(0, c['noise']))
+            if i and i % every == 0:
+                c['doser'].step()
+        on = [c['pump'].on() for c in channels]
+        for c, o in zip(channels, on):
+            if o:
+                c['pump'].seconds += dt
+        pool.step(dt, on[0], on[1])
+        for c in channels:
+            c['trace'].append(c['read']())
+    return channels, dt
+
+
+def report(channels, dt):
+    for c in channels:
+        trace, sp, band = c['trace'], c['sp'], c['band']
+        settled = None
+        for i in range(len(trace) - 1, -1, -1):
+            if abs(trace[i] - sp) > band:
+                settled = (i + 1) * dt if i + 1 < len(trace) else None
+                break
+        else:
+            settled = 0
+        past = max(0.0, max((v - sp) * c['direction'] for v in trace))  # dosed beyond the setpoint
+        last_day = trace[-int(86400 / dt):]
+        mean = sum(last_day) / len(last_day)
+        spread = math.sqrt(sum((v - mean) ** 2 for v in last_day) / len(last_day))
+        litres = c['pump'].seconds * PUMP_ML_PER_S / 1000
+        print('  {:4} settled {:>9}  overshoot {:7.3f}  chemical {:6.2f} l  last day {:.3f} +/- {:.3f}'.format(
+            c['key'], 'never' if settled is None else '{:.1f} h'.format(settled / 3600),
+            past, litres, mean, spread))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the dosing controller on a pool model')
+    ap.add_argument('--days', type=float, default=3)
+    ap.add_argument('--controller', choices=('pid', 'onoff', 'both'), default='both')
+    ap.add_argument('--conf', action='append', default=[], metavar='KEY=VALUE',
+                    help='override a conf.txt dosing setting (repeatable)')
+    args = ap.parse_args()
+    conf = dict(CONF)
+    for kv in args.conf:
+        k, v = kv.split('=', 1)
+        conf[k] = type(conf[k])(v)
+    for name in ('pid', 'onoff') if args.controller == 'both' else (args.controller,):
+        print(name)
+        report(*simulate(conf, name, args.days))
+
+
+if __name__ == '__main__':
+    main()
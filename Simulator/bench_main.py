@@ -0,0 +1,142 @@
+# bench_main.py Benchmark the unmodified control loop on simulated hardware
+# Released under the MIT licence.
+
+# Runs main.py in the simulator and reports:
+#   boot to first read time from start until the first pH reading is taken
+#   boot to online     time from start until 'online' is published, and the
+#                      boot phase timings the firmware reports in it
+#   cycle latency      first EZO 'R' command of a reading's burst (ezo_samples
+#                      commands) to the reading arriving at the broker; not
+#                      measured with ezo_sample_mode continuous
+#   cycle period       interval between successive pH readings at the broker
+#   publishes/s        broker messages per second while sampling
+#   CPU use            host CPU time per second while the loop runs on its
+#                      own, mostly tasks waking up to find nothing to do
+#   command to pump    broker delivering 'ph:on:N' to the pump pin going high
+#   memory per cycle   growth per report cycle of the heap allocated by the
+#                      firmware's own files, and the largest it got
+#
+#   python3 Simulator/bench_main.py --cycles 5 --report-interval 2
+#   python3 Simulator/bench_main.py --broker-down 20   # broker unreachable at boot
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from sim import ROOT, Simulation
+
+
+def firmware_heap():  # bytes currently allocated from the repository's .py files
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, ROOT + '/*.py'),
+         tracemalloc.Filter(False, os.path.join(ROOT, 'Simulator', '*'))])
+    return sum(stat.size for stat in snapshot.statistics('filename'))
+
+
+def summary(values, unit, scale=1.0):
+    if not values:
+        return 'n/a'
+    values = [v * scale for v in values]
+    return '{:8.1f} {} (min {:.1f}, max {:.1f}, n={})'.format(
+        statistics.mean(values), unit, min(values), max(values), len(values))
+
+
+async def scenario(sim, cycles, commands, idle, broker_down):
+    res = {}
+    ph_topic = sim.topic('ph_topic_pub')
+    if broker_down:
+        sim.broker.up = False
+        asyncio.get_event_loop().call_later(broker_down, setattr, sim.broker, 'up', True)
+    online = await sim.wait_message('resp_pub', prefix=b'online', timeout=600)
+    res['boot'] = time.monotonic() - sim.t0
+    res['phases'] = json.loads(online.payload.split(b':', 1)[1]) if b':' in online.payload else {}
+    ezo = sim.board.ezo[int(sim.conf['ph_uart_port'])]
+    await sim.wait_for(lambda: any(c == 'R' for _, c in ezo.commands), timeout=60)
+    res['first_read'] = next(t for t, c in ezo.commands if c == 'R') - sim.t0
+
+    # Sampling cycles.
+    tracemalloc.start()
+    first = len(sim.broker.messages)
+    start = time.monotonic()
+    mem = []
+    arrivals = []
+    for _ in range(cycles):
+        n = len(sim.broker.topic(ph_topic))
+        await sim.wait_for(lambda: len(sim.broker.topic(ph_topic)) > n, timeout=120)
+        arrivals.append(sim.broker.topic(ph_topic)[-1].time)
+        mem.append(firmware_heap())
+    elapsed = time.monotonic() - start
+    tracemalloc.stop()
+    res['publish_rate'] = (len(sim.broker.messages) - first) / elapsed
+    res['period'] = [b - a for a, b in zip(arrivals, arrivals[1:])]
+    reads = [t for t, c in ezo.commands if c == 'R']
+    res['latency'] = []
+    # Each reading is one burst of ezo_samples 'R's, from boot on.  When the
+    # bursts run back to back the next one starts before a reading arrives, so
+    # pair each arrival with the first 'R' of the latest burst completed before it.
+    n = sys.modules['config'].Sensor.ezo_samples
+    bursts = [reads[i:i + n] for i in range(0, len(reads) - n + 1, n)]
+    for t in arrivals:
+        done = [b for b in bursts if b[-1] <= t]
+        if done:
+            res['latency'].append(t - done[-1][0])
+    res['mem_growth'] = [b - a for a, b in zip(mem, mem[1:])]
+    res['mem_peak'] = max(mem)
+
+    # CPU use, with the scenario asleep rather than polling.
+    cpu = time.process_time()
+    await asyncio.sleep(idle)
+    res['cpu'] = (time.process_time() - cpu) / idle
+
+    # Command to pump latency.
+    pump = sim.pin('pump_1_pin')
+    res['pump'] = []
+    for _ in range(commands):
+        edges = len(pump.edges)
+        t = time.monotonic()
+        await sim.command('ph:on:1')
+        await sim.wait_for(lambda: len(pump.edges) > edges and pump.edges[edges][1] == 1, timeout=30)
+        res['pump'].append(pump.edges[edges][0] - t)
+        await sim.wait_for(lambda: pump.value() == 0, timeout=30)
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark main.py on simulated hardware')
+    ap.add_argument('--cycles', type=int, default=5, help='report cycles to measure')
+    ap.add_argument('--commands', type=int, default=5, help='pump commands to time')
+    ap.add_argument('--report-interval', type=int, default=2)
+    ap.add_argument('--idle', type=float, default=5, help='seconds to measure CPU use over')
+    ap.add_argument('--broker-latency', type=float, default=0.0, help='seconds')
+    ap.add_argument('--broker-down', type=float, default=0.0, help='seconds the broker is unreachable after boot')
+    ap.add_argument('--conf', action='append', default=[], metavar='KEY=VALUE',
+                    help='extra conf.txt setting (repeatable)')
+    ap.add_argument('--verbose', action='store_true', help="show the firmware's own output")
+    args = ap.parse_args()
+    conf = {'report_interval': args.report_interval}
+    conf.update(kv.split('=', 1) for kv in args.conf)
+    sim = Simulation(conf, broker_latency=args.broker_latency)
+    # Discard rather than capture the firmware's output, which would count as heap.
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        res = sim.run(lambda s: scenario(s, args.cycles + 1, args.commands, args.idle, args.broker_down))
+    print('boot to 1st read {:8.1f} s'.format(res['first_read']))
+    print('boot to online   {:8.1f} s  {}'.format(res['boot'], json.dumps(res['phases'])))
+    print('cycle latency    ' + summary(res['latency'], 'ms', 1000))
+    print('cycle period     ' + summary(res['period'], 'ms', 1000))
+    print('publishes/s      {:8.2f}'.format(res['publish_rate']))
+    print('CPU use          {:8.1f} %'.format(res['cpu'] * 100))
+    print('command to pump  ' + summary(res['pump'], 'ms', 1000))
+    print('memory per cycle ' + summary(res['mem_growth'], 'B'))
+    print('firmware heap    {:8.0f} B max'.format(res['mem_peak']))
+
+
+if __name__ == '__main__':
+    main()
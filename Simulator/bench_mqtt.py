@@ -0,0 +1,242 @@
+# bench_mqtt.py Host-side benchmark of the mqtt_as receive path
+# Released under the MIT licence.
+
+# Feeds bursts of retained PUBLISH packets through MQTTClient.wait_msg() from a
+# fake socket and reports throughput and transient heap use per message. Then
+# publishes qos 0 messages into the fake socket and reports publishes per second
+# and socket writes per publish. Finally publishes qos 1 messages concurrently to
+# a fake broker that answers each PUBLISH with a PUBACK after a fixed latency.
+#
+#   python3 Simulator/bench_mqtt.py
+#   git show HEAD~1:mqtt_as.py > /tmp/mqtt_as_old.py
+#   python3 Simulator/bench_mqtt.py --mqtt-as /tmp/mqtt_as_old.py   # compare
+
+import argparse
+import importlib.util
+import struct
+import time
+import tracemalloc
+
+import shims
+
+shims.install()
+import uasyncio as asyncio
+
+
+class FakeSocket:
+    """Non-blocking socket that returns at most `chunk` bytes per read."""
+    def __init__(self, data=b'', chunk=64):
+        self.rx = bytearray(data)
+        self.pos = 0
+        self.chunk = chunk
+        self.reads = 0
+        self.writes = 0
+        self.bytes_out = 0
+
+    def pending(self):
+        return len(self.rx) - self.pos
+
+    def read(self, n=-1):
+        self.reads += 1
+        if self.pos >= len(self.rx):
+            return None
+        k = min(n, self.chunk, len(self.rx) - self.pos)
+        data = bytes(self.rx[self.pos:self.pos + k])
+        self.pos += k
+        return data
+
+    def readinto(self, buf):
+        self.reads += 1
+        if self.pos >= len(self.rx):
+            return None
+        k = min(len(buf), self.chunk, len(self.rx) - self.pos)
+        buf[:k] = self.rx[self.pos:self.pos + k]
+        self.pos += k
+        return k
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes_out += len(data)
+        return len(data)
+
+    def feed(self, data):
+        self.rx += data
+
+    def close(self):
+        pass
+
+
+class AckingSocket(FakeSocket):
+    """Fake broker link: every qos 1 PUBLISH is PUBACKed after `latency` s."""
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self.tx = bytearray()
+
+    def write(self, data):
+        self.tx += bytes(data)
+        while len(self.tx) >= 2:  # split the written stream into packets
+            sz = 0
+            sh = 0
+            i = 1
+            while i < len(self.tx):
+                b = self.tx[i]
+                sz |= (b & 0x7f) << sh
+                sh += 7
+                i += 1
+                if not b & 0x80:
+                    break
+            else:
+                break
+            if len(self.tx) < i + sz:
+                break
+            op = self.tx[0]
+            body = self.tx[i:i + sz]
+            del self.tx[:i + sz]
+            if op & 0xf0 == 0x30 and op & 6:
+                tl = body[0] << 8 | body[1]
+                pid = bytes(body[2 + tl:4 + tl])
+                asyncio.get_event_loop().call_later(self.latency, self.feed, b'\x40\x02' + pid)
+        return super().write(data)
+
+
+def remaining_length(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def publish_packet(topic, payload, qos=0, pid=1, retain=True):
+    var = struct.pack('!H', len(topic)) + topic
+    if qos:
+        var += struct.pack('!H', pid)
+    body = var + payload
+    return bytes([0x30 | qos << 1 | retain]) + remaining_length(len(body)) + body
+
+
+def burst(count, size, qos):
+    return b''.join(publish_packet(b'Pool/retained/%d' % i, b'x' * size, qos, i + 1)
+                    for i in range(count))
+
+
+def load_mqtt_as(path):
+    if path is None:
+        import mqtt_as
+        return mqtt_as
+    spec = importlib.util.spec_from_file_location('mqtt_as_under_test', path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def make_client(mod, sock):
+    cfg = dict(mod.config)
+    cfg.update(server='127.0.0.1', hostname='bench', subs_cb=lambda *_: None)
+    client = mod.MQTTClient(cfg)
+    client._isconnected = True
+    client._sock = sock
+    client._stream = asyncio.StreamReader(sock)
+    return client
+
+
+async def drain(client, sock):
+    n = 0
+    while sock.pending():
+        await client.wait_msg()
+        n += 1
+    return n
+
+
+def run(mod, count, size, qos, chunk):
+    data = burst(count, size, qos)
+    # Throughput pass.
+    sock = FakeSocket(data, chunk)
+    client = make_client(mod, sock)
+    t = time.perf_counter()
+    n = asyncio.run(drain(client, sock))
+    dt = time.perf_counter() - t
+    # Allocation pass: transient heap peak per message.
+    sock = FakeSocket(data, chunk)
+    client = make_client(mod, sock)
+
+    async def measured():
+        peaks = 0
+        while sock.pending():
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            await client.wait_msg()
+            peaks += tracemalloc.get_traced_memory()[1] - base
+        return peaks
+
+    tracemalloc.start()
+    peaks = asyncio.run(measured())
+    tracemalloc.stop()
+    return n, dt, peaks / max(n, 1), sock.reads
+
+
+def run_publish(mod, count, size):
+    sock = FakeSocket()
+    client = make_client(mod, sock)
+    payload = 'x' * size
+
+    async def publish():
+        for _ in range(count):
+            await client.publish('Pool/Ph', payload)
+
+    t = time.perf_counter()
+    asyncio.run(publish())
+    dt = time.perf_counter() - t
+    return count / dt, sock.writes / count
+
+
+def run_qos1(mod, count, latency, concurrency):
+    sock = AckingSocket(latency)
+    client = make_client(mod, sock)
+
+    async def publish():
+        reader = asyncio.create_task(client._handle_msg())
+        sent = 0
+        t = time.perf_counter()
+        while sent < count:
+            batch = min(concurrency, count - sent)
+            await asyncio.gather(*[client.publish('Pool/Ph', '7.2', qos=1) for _ in range(batch)])
+            sent += batch
+        dt = time.perf_counter() - t
+        reader.cancel()
+        return dt
+
+    return count / asyncio.run(publish())
+
+
+def main():
+    ap = argparse.ArgumentParser(description='mqtt_as receive path benchmark')
+    ap.add_argument('--mqtt-as', help='mqtt_as.py to benchmark (default: repository copy)')
+    ap.add_argument('--count', type=int, default=200, help='messages per burst')
+    ap.add_argument('--chunk', type=int, default=64, help='max bytes per socket read')
+    ap.add_argument('--qos', type=int, default=1)
+    ap.add_argument('--latency', type=int, default=50, help='broker PUBACK latency (ms)')
+    args = ap.parse_args()
+    mod = load_mqtt_as(args.mqtt_as)
+    print('{:>8} {:>10} {:>12} {:>10}'.format('payload', 'msg/s', 'peak B/msg', 'reads'))
+    for size in (16, 256, 1024, 4096):
+        n, dt, peak, reads = run(mod, args.count, size, args.qos, args.chunk)
+        print('{:>8} {:>10.0f} {:>12.0f} {:>10}'.format(size, n / dt, peak, reads))
+    print()
+    print('{:>8} {:>10} {:>12}'.format('payload', 'pub/s', 'writes/pub'))
+    for size in (16, 256, 1024):
+        rate, writes = run_publish(mod, args.count, size)
+        print('{:>8} {:>10.0f} {:>12.1f}'.format(size, rate, writes))
+    print()
+    print('qos 1, {} ms broker latency'.format(args.latency))
+    print('{:>8} {:>10}'.format('parallel', 'pub/s'))
+    for concurrency in (1, 4, 8):
+        rate = run_qos1(mod, args.count, args.latency / 1000, concurrency)
+        print('{:>8} {:>10.1f}'.format(concurrency, rate))
+
+
+if __name__ == '__main__':
+    main()
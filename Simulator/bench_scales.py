@@ -0,0 +1,76 @@
+# bench_scales.py Scales._stabilizer against the original pairwise version
+# Released under the MIT licence.
+
+# Times the reading stabilizer on simulated load cell readings (a steady weight
+# with HX711 noise and a few upward spikes) at 10, 100 and 1000 samples, and
+# shows how many neighbours the chosen reading has, which should be the same
+# for both.  The original is copied below as it was; it divides by the
+# reading, so it is only fed positive readings well away from zero.  The new
+# version is timed on an array, as stable_value() passes it, and sorts it in
+# place (re-sorting sorted data costs heapsort the same).
+#
+#   python3 Simulator/bench_scales.py --sizes 10 100 1000
+
+import argparse
+import random
+from array import array
+import time
+
+import shims
+
+shims.install()
+import hardware
+
+hardware.install()
+from scales import Scales
+
+
+def stabilizer_pairwise(values, deviation=10):
+    weights = []
+    for prev in values:
+        weights.append(sum([1 for current in values if abs(prev - current) / (prev / 100) <= deviation]))
+    return sorted(zip(values, weights), key=lambda x: x[1]).pop()[0]
+
+
+def weight(values, v, deviation=10):
+    return sum(1 for c in values if abs(v - c) <= abs(v) * deviation / 100)
+
+
+def readings(n, level=50000, noise=3000, spikes=0.05):
+    out = []
+    for _ in range(n):
+        v = level + random.gauss(0, noise)
+        if random.random() < spikes:
+            v += level
+        out.append(int(v) or 1)
+    return out
+
+
+def timed(f, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        r = f()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return r, best
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the Scales reading stabilizer')
+    ap.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args()
+    random.seed(args.seed)
+    print('{:>6} {:>12} {:>12} {:>8}  {}'.format('reads', 'pairwise ms', 'sorted ms', 'speedup', 'neighbours'))
+    for n in args.sizes:
+        values = readings(n)
+        repeat = max(1, 2000 // n)
+        old, t_old = timed(lambda: stabilizer_pairwise(values), max(1, repeat // 10))
+        buf = array('i', values)
+        new, t_new = timed(lambda: Scales._stabilizer(buf), repeat)
+        print('{:6} {:12.3f} {:12.3f} {:7.0f}x  {} / {}'.format(
+            n, t_old * 1e3, t_new * 1e3, t_old / t_new, weight(values, old), weight(values, new)))
+
+if __name__ == '__main__':
+    main()
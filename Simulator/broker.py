@@ -0,0 +1,265 @@
+# broker.py In-process MQTT 3.1.1 broker for the simulator
+# Released under the MIT licence.
+
+# install() registers a stand-in for MicroPython's usocket whose sockets
+# connect straight to `broker` instead of the network.  The broker
+# speaks enough MQTT for mqtt_as (CONNECT, PUBLISH qos 0/1, PUBACK, SUBSCRIBE,
+# PINGREQ, DISCONNECT), records every message it receives and lets a
+# simulation inject commands as if Home Assistant had sent them.
+
+import asyncio
+import errno
+import struct
+import sys
+import time
+import types
+
+
+def _remaining_length(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def _matches(pattern, topic):
+    if pattern == topic or pattern == b'#':
+        return True
+    if pattern.endswith(b'/#'):
+        return topic.startswith(pattern[:-1]) or topic == pattern[:-2]
+    return False
+
+
+class Message:
+    def __init__(self, topic, payload, qos, retain, dup):
+        self.time = time.monotonic()
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.dup = dup
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.topic.decode(), self.payload.decode(errors='replace'))
+
+
+class Broker:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.messages = []  # every PUBLISH received from clients
+        self.listeners = []  # callables(Message) called as messages arrive
+        self.sessions = []
+        self.retained = {}
+        self.latency = 0.0  # seconds before any reply reaches the client
+        self.up = True  # False simulates an unreachable broker
+        self.connects = 0
+
+    def topic(self, topic):
+        topic = topic.encode() if isinstance(topic, str) else topic
+        return [m for m in self.messages if m.topic == topic]
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        """Deliver a message to every subscribed client, as Home Assistant would."""
+        topic = topic.encode() if isinstance(topic, str) else topic
+        payload = payload.encode() if isinstance(payload, str) else payload
+        if retain:
+            self.retained[topic] = payload
+        for s in self.sessions:
+            s.deliver(topic, payload, qos, retain)
+
+    def _received(self, msg):
+        self.messages.append(msg)
+        if msg.retain:
+            self.retained[msg.topic] = msg.payload
+        for listener in self.listeners:
+            listener(msg)
+        for s in self.sessions:
+            s.deliver(msg.topic, msg.payload, min(msg.qos, 1), False)
+
+
+broker = Broker()
+
+
+class BrokerSocket:
+    """Non-blocking client socket connected to the in-process broker."""
+    def __init__(self, *args):
+        self._rx = bytearray()
+        self._tx = bytearray()
+        self._closed = False
+        self._connected = False
+        self.subscriptions = []
+        self.writes = 0
+        self.reads = 0
+        self.pid = 0
+        self._readers = []  # futures of tasks sleeping in wait_readable()
+
+    def setblocking(self, flag):
+        pass
+
+    def settimeout(self, t):
+        pass
+
+    def connect(self, addr):
+        if not broker.up:
+            raise OSError(errno.ECONNREFUSED)
+        self._connected = True
+        broker.sessions.append(self)
+
+    def close(self):
+        self._closed = True
+        if self in broker.sessions:
+            broker.sessions.remove(self)
+        self._wake()
+
+    def fileno(self):
+        return -1
+
+    # ---- client side ----
+    def _check(self):
+        if self._closed or not broker.up:
+            raise OSError(errno.ECONNRESET)
+
+    def read(self, n=-1):
+        self._check()
+        self.reads += 1
+        if not self._rx:
+            return None
+        if n is None or n < 0:
+            n = len(self._rx)
+        data = bytes(self._rx[:n])
+        del self._rx[:n]
+        return data
+
+    def readinto(self, buf, n=-1):
+        self._check()
+        self.reads += 1
+        if not self._rx:
+            return None
+        k = min(len(buf) if n < 0 else n, len(self._rx))
+        buf[:k] = self._rx[:k]
+        del self._rx[:k]
+        return k
+
+    def readable(self):
+        return bool(self._rx) or self._closed
+
+    async def wait_readable(self):  # returns once read() has data or will raise
+        if self.readable() or not broker.up:
+            return
+        fut = asyncio.get_event_loop().create_future()
+        self._readers.append(fut)
+        try:
+            await fut
+        finally:
+            if fut in self._readers:
+                self._readers.remove(fut)
+
+    def _wake(self):
+        for fut in self._readers:
+            if not fut.done():
+                fut.set_result(None)
+        self._readers.clear()
+
+    def write(self, data, n=-1):
+        self._check()
+        self.writes += 1
+        if isinstance(data, str):
+            data = data.encode()
+        data = bytes(data if n < 0 else data[:n])
+        self._tx += data
+        self._parse()
+        return len(data)
+
+    # ---- broker side ----
+    def _send(self, data):
+        def arrive():
+            if not self._closed:
+                self._rx += data
+                self._wake()
+        if broker.latency:
+            asyncio.get_event_loop().call_later(broker.latency, arrive)
+        else:
+            arrive()
+
+    def deliver(self, topic, payload, qos, retain):
+        if not any(_matches(p, topic) for p in self.subscriptions):
+            return
+        var = struct.pack('!H', len(topic)) + topic
+        if qos:
+            self.pid = self.pid % 65535 + 1
+            var += struct.pack('!H', self.pid)
+        body = var + payload
+        self._send(bytes([0x30 | qos << 1 | retain]) + _remaining_length(len(body)) + body)
+
+    def _parse(self):
+        while len(self._tx) >= 2:
+            sz = 0
+            sh = 0
+            i = 1
+            while i < len(self._tx):
+                b = self._tx[i]
+                sz |= (b & 0x7f) << sh
+                sh += 7
+                i += 1
+                if not b & 0x80:
+                    break
+            else:
+                return
+            if len(self._tx) < i + sz:
+                return
+            op = self._tx[0]
+            body = bytes(self._tx[i:i + sz])
+            del self._tx[:i + sz]
+            self._packet(op, body)
+
+    def _packet(self, op, body):
+        kind = op & 0xf0
+        if kind == 0x10:  # CONNECT
+            broker.connects += 1
+            self._send(b'\x20\x02\x00\x00')
+            for topic, payload in broker.retained.items():
+                self.deliver(topic, payload, 0, True)
+        elif kind == 0x30:  # PUBLISH
+            qos = (op >> 1) & 3
+            tl = body[0] << 8 | body[1]
+            topic = body[2:2 + tl]
+            pos = 2 + tl
+            if qos:
+                pid = body[pos:pos + 2]
+                pos += 2
+            broker._received(Message(topic, body[pos:], qos, op & 1, (op >> 3) & 1))
+            if qos == 1:
+                self._send(b'\x40\x02' + pid)
+        elif kind == 0x80:  # SUBSCRIBE
+            pid = body[:2]
+            pos = 2
+            codes = b''
+            while pos < len(body):
+                tl = body[pos] << 8 | body[pos + 1]
+                self.subscriptions.append(body[pos + 2:pos + 2 + tl])
+                codes += bytes([min(body[pos + 2 + tl], 1)])
+                pos += 3 + tl
+            self._send(b'\x90' + _remaining_length(2 + len(codes)) + pid + codes)
+        elif kind == 0xc0:  # PINGREQ
+            self._send(b'\xd0\x00')
+        elif kind == 0xe0:  # DISCONNECT
+            self.close()
+
+
+def getaddrinfo(host, port, *args):
+    return [(2, 1, 0, '', (host, port))]
+
+
+def install():
+    m = types.ModuleType('usocket')
+    m.socket = BrokerSocket
+    m.getaddrinfo = getaddrinfo
+    m.AF_INET = 2
+    m.SOCK_STREAM = 1
+    m.SOCK_DGRAM = 2
+    sys.modules['usocket'] = m
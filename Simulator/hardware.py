@@ -0,0 +1,390 @@
+# hardware.py Simulated ESP32 peripherals for the pool controller
+# Released under the MIT licence.
+
+# Fake versions of the machine, network, onewire and ds18x20 modules.  All
+# devices hang off the module level `board`, which a simulation resets and
+# then inspects: pin edges are timestamped, the EZO circuits on the UARTs
+# answer commands with realistic latencies from a configurable pool model, and
+# an HX711 on two pins converts a load cell at 10 samples per second.
+
+import asyncio
+import random
+import sys
+import time
+import types
+
+
+class Board:
+    def __init__(self):
+        self.pins = {}  # id: Pin
+        self.uarts = {}  # port: UART
+        self.ezo = {}  # UART port: EZOModule
+        self.ds18b20 = {}  # rom: temperature in C
+        self.hx711 = {}  # pin id: HX711Module on that pin
+        self.ssid = 'sim_ssid'
+        self.rssi = -55
+        self.wifi_up = True
+
+
+board = Board()
+
+
+def reset_board():
+    board.__init__()
+    return board
+
+
+# ---- machine ----------------------------------------------------------------
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_FALLING = 2
+    IRQ_RISING = 1
+
+    def __init__(self, id, mode=IN, pull=None, value=None):
+        self.id = id
+        self.mode = mode
+        self._value = 0 if value is None else int(bool(value))
+        self.edges = []  # (time.monotonic(), value) for every change
+        self._irq = None
+        self._trigger = 0
+        self.source = None  # callable giving the level of an input driven by a model
+        self.model = None  # device model that watches this pin
+        board.pins[id] = self
+        if id in board.hx711:
+            board.hx711[id].attach(self)
+
+    def __repr__(self):
+        return 'Pin({})'.format(self.id)
+
+    def value(self, v=None):
+        if v is None:
+            if self.source is not None:
+                return self.source()
+            return self._value
+        self._set(int(bool(v)))
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def on(self):
+        self._set(1)
+
+    def off(self):
+        self._set(0)
+
+    def _set(self, v):
+        if v != self._value:
+            self.edges.append((time.monotonic(), v))
+            self._value = v
+            if self.model:
+                self.model.clock(self, v)
+            if self._irq and self._trigger & (self.IRQ_RISING if v else self.IRQ_FALLING):
+                self._irq(self)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self._irq = handler
+        self._trigger = trigger
+        if self.model and handler:
+            self.model.armed(self)
+
+    def drive(self, v):  # change an input level from the simulated outside world
+        self._set(int(bool(v)))
+
+
+class UART:
+    def __init__(self, port, baudrate=9600, tx=None, rx=None, **kwargs):
+        self.port = port
+        self.writes = 0
+        board.uarts[port] = self
+
+    def init(self, baudrate=9600, **kwargs):
+        pass
+
+    def write(self, buf):
+        self.writes += 1
+        if isinstance(buf, str):
+            buf = buf.encode()
+        module = board.ezo.get(self.port)
+        if module is not None:
+            module.receive(bytes(buf))
+        return len(buf)
+
+    def any(self):
+        module = board.ezo.get(self.port)
+        return module.pending() if module else 0
+
+    def read(self, n=-1):
+        module = board.ezo.get(self.port)
+        if module is None:
+            return None
+        return module.take(n)
+
+    async def wait_readable(self):  # sleeps until the circuit's next reply is due
+        module = board.ezo.get(self.port)
+        while module is None or not module.pending():
+            due = module.next_due() if module else None
+            await asyncio.sleep(0.01 if due is None else max(due - time.monotonic(), 0.0005))
+
+
+class RTC:
+    def datetime(self, *args):
+        return time.localtime()[:7] + (0,)
+
+
+def unique_id():
+    return b'\x24\x0a\xc4\x00\x00\x01'
+
+
+def reset():
+    raise SystemExit('machine.reset()')
+
+
+# ---- EZO circuits ---------------------------------------------------------
+
+class EZOModule:
+    """
+    Atlas Scientific EZO circuit in UART mode with response codes on.
+    `signal` is a callable returning the true value being measured.  A
+    fraction `spikes` of readings are off by `spike_size`, as when an air
+    bubble passes the probe.
+    """
+    READ_LATENCY = 0.9
+    COMMAND_LATENCY = 0.3
+
+    def __init__(self, port, signal, noise=0.0, read_latency=READ_LATENCY,
+                 command_latency=COMMAND_LATENCY, spikes=0.0, spike_size=0.0):
+        self.signal = signal
+        self.noise = noise
+        self.spikes = spikes
+        self.spike_size = spike_size
+        self.read_latency = read_latency
+        self.command_latency = command_latency
+        self.commands = []  # (time.monotonic(), command)
+        self.continuous = False
+        self._rx = b''
+        self._ready = b''  # answered and waiting to be read from the UART
+        self._out = []  # (due time, bytes)
+        self._next_stream = 0.0
+        board.ezo[port] = self
+
+    def reading(self):
+        v = self.signal()
+        if self.noise:
+            v += random.gauss(0, self.noise)
+        if self.spikes and random.random() < self.spikes:
+            v += random.choice((-1, 1)) * self.spike_size
+        return '{:.3f}'.format(v).encode()
+
+    def receive(self, data):
+        self._rx += data
+        while b'\r' in self._rx:
+            cmd, self._rx = self._rx.split(b'\r', 1)
+            self._command(cmd.decode())
+
+    def _command(self, cmd):
+        now = time.monotonic()
+        self.commands.append((now, cmd))
+        c = cmd.upper()
+        if c == 'R':
+            self._out.append((now + self.read_latency, self.reading() + b'\r*OK\r'))
+        elif c in ('C,1', 'C,0'):
+            self.continuous = c == 'C,1'
+            self._next_stream = now + self.read_latency
+            self._out.append((now + self.command_latency, b'*OK\r'))
+        elif c.startswith(('CAL', 'T,', 'I', 'STATUS', 'RESPONSE', 'L,')):
+            self._out.append((now + self.command_latency, b'*OK\r'))
+        else:
+            self._out.append((now + self.command_latency, b'*ER\r'))
+
+    def _due(self):
+        now = time.monotonic()
+        while self.continuous and self._next_stream <= now:
+            self._out.append((self._next_stream, self.reading() + b'\r'))
+            self._next_stream += self.read_latency
+        self._out.sort(key=lambda o: o[0])
+        data = b''
+        while self._out and self._out[0][0] <= now:
+            data += self._out.pop(0)[1]
+        self._ready += data
+
+    def pending(self):
+        self._due()
+        return len(self._ready)
+
+    def next_due(self):  # time the next reply becomes readable, or None
+        times = [o[0] for o in self._out]
+        if self.continuous:
+            times.append(self._next_stream)
+        return min(times) if times else None
+
+    def take(self, n=-1):
+        self._due()
+        if not self._ready:
+            return None
+        if n is None or n < 0:
+            n = len(self._ready)
+        data, self._ready = self._ready[:n], self._ready[n:]
+        return data
+
+
+# ---- HX711 load cell ADC --------------------------------------------------
+
+class HX711Module:
+    """
+    HX711 between a load cell and the d_out/pd_sck pins.  `signal` is a
+    callable returning the true raw count.  DOUT falls when a conversion is
+    ready (every 1/RATE s, and SETTLE s after power up); PD_SCK held high for
+    longer than POWER_DOWN powers it down.
+    """
+    RATE = 10
+    SETTLE = 0.4
+    POWER_DOWN = 0.001  # 60 us on the chip; generous for the Python host
+
+    def __init__(self, d_out, pd_sck, signal, noise=0.0):
+        self.d_out = d_out
+        self.pd_sck = pd_sck
+        self.signal = signal
+        self.noise = noise
+        self.conversions = 0  # readings clocked out
+        self.power_ups = 0
+        self._next = time.monotonic() + self.SETTLE
+        self._word = None  # bits being clocked out
+        self._pulses = 0
+        self._rise = 0.0
+        board.hx711[d_out] = self
+        board.hx711[pd_sck] = self
+
+    def attach(self, pin):
+        pin.model = self
+        if pin.id == self.d_out:
+            pin.source = self._level
+
+    def _level(self):
+        if self._word is not None:  # bit n is on DOUT after the nth rising edge
+            return (self._word >> (24 - self._pulses)) & 1
+        return 0 if time.monotonic() >= self._next else 1
+
+    def clock(self, pin, v):
+        if pin.id != self.pd_sck:
+            return
+        now = time.monotonic()
+        if v:
+            self._rise = now
+            if self._word is None:
+                if now < self._next:
+                    return  # gain select pulses, or clocked before the data is ready
+                value = self.signal()
+                if self.noise:
+                    value += random.gauss(0, self.noise)
+                self._word = int(value) & 0xffffff
+                self._pulses = 0
+                self.conversions += 1
+            self._pulses += 1
+            if self._pulses > 24:  # 25th pulse: DOUT back high until the next conversion
+                self._word = None
+                self._next = now + 1 / self.RATE
+        elif now - self._rise > self.POWER_DOWN:  # was held high: powered down, now back up
+            self.power_ups += 1
+            self._word = None
+            self._next = now + self.SETTLE
+
+    def armed(self, pin):  # a falling edge IRQ was set on DOUT: raise it when ready
+        if pin.id == self.d_out:
+            delay = max(0.0, self._next - time.monotonic())
+            asyncio.get_event_loop().call_later(delay, self._fire, pin)
+
+    def _fire(self, pin):
+        if pin._irq and pin._trigger & pin.IRQ_FALLING and not self._level():
+            pin._irq(pin)
+
+
+# ---- network ----------------------------------------------------------------
+
+class WLAN:
+    def __init__(self, interface=0):
+        self._connected = False
+
+    def active(self, *args):
+        return True
+
+    def config(self, *args, **kwargs):
+        pass
+
+    def connect(self, ssid=None, password=None):
+        self._connected = board.wifi_up
+
+    def disconnect(self):
+        self._connected = False
+
+    def isconnected(self):
+        return board.wifi_up
+
+    def status(self, param=None):
+        if param == 'rssi':
+            return board.rssi
+        return 1010 if board.wifi_up else 201  # STAT_GOT_IP / STAT_NO_AP_FOUND
+
+    def scan(self):
+        return [(board.ssid.encode(), b'\x00' * 6, 6, board.rssi, 3, False)]
+
+
+# ---- onewire / ds18x20 --------------------------------------------------------
+
+class OneWireError(Exception):
+    pass
+
+
+class OneWire:
+    def __init__(self, pin):
+        self.pin = pin
+
+
+class DS18X20:
+    CONVERSION_TIME = 0.75
+
+    def __init__(self, onewire):
+        self.ow = onewire
+        self.conversions = 0
+        self._converted = 0.0
+
+    def scan(self):
+        return [bytearray(rom) for rom in board.ds18b20]
+
+    def convert_temp(self):
+        if not board.ds18b20:  # reset gets no presence pulse: unplugged or shorted bus
+            raise OneWireError()
+        self.conversions += 1
+        self._converted = time.monotonic()
+
+    def read_temp(self, rom):
+        if time.monotonic() - self._converted < self.CONVERSION_TIME:
+            return 85.0  # power-on value, as the real sensor returns if read early
+        return board.ds18b20[bytes(rom)]
+
+
+def modules():
+    """The simulated modules, keyed by their MicroPython names."""
+    def module(name, **attrs):
+        m = types.ModuleType(name)
+        m.__dict__.update(attrs)
+        return m
+
+    return {
+        'machine': module('machine', Pin=Pin, UART=UART, RTC=RTC, unique_id=unique_id,
+                          reset=reset, freq=lambda *a: 240000000),
+        'network': module('network', WLAN=WLAN, STA_IF=0, AP_IF=1, STAT_IDLE=1000,
+                          STAT_CONNECTING=1001, STAT_GOT_IP=1010),
+        'onewire': module('onewire', OneWire=OneWire, OneWireError=OneWireError),
+        'ds18x20': module('ds18x20', DS18X20=DS18X20),
+        'ntptime': module('ntptime', settime=lambda: None),
+        'esp32': module('esp32', raw_temperature=lambda: 120),
+    }
+
+
+def install():
+    sys.modules.update(modules())
@@ -0,0 +1,145 @@
+# shims.py CPython stand-ins for the MicroPython modules used by the firmware
+# Released under the MIT licence.
+
+# install() registers modules named like their MicroPython counterparts in
+# sys.modules, so the firmware files in the repository root can be imported
+# unmodified on a Linux host.  Peripherals come from hardware.py and the
+# network from broker.py.
+
+import asyncio
+import binascii
+import errno
+import gc
+import json
+import os
+import struct
+import sys
+import time
+import tracemalloc
+import types
+
+import broker
+import hardware
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_T0 = time.monotonic_ns()
+
+
+def ticks_ms():
+    return (time.monotonic_ns() - _T0) // 1000000
+
+
+def ticks_us():
+    return (time.monotonic_ns() - _T0) // 1000
+
+
+def ticks_diff(a, b):
+    return a - b
+
+
+def ticks_add(a, b):
+    return a + b
+
+
+def _module(name, **attrs):
+    m = types.ModuleType(name)
+    m.__dict__.update(attrs)
+    return m
+
+
+def _utime():
+    return _module('utime', time=time.time, localtime=time.localtime,
+                   sleep=time.sleep, sleep_ms=lambda ms: time.sleep(ms / 1000),
+                   sleep_us=lambda us: time.sleep(us / 1000000),
+                   ticks_ms=ticks_ms, ticks_us=ticks_us,
+                   ticks_diff=ticks_diff, ticks_add=ticks_add)
+
+
+def _uasyncio():
+    m = _module('uasyncio')
+    m.__dict__.update({k: getattr(asyncio, k) for k in dir(asyncio) if not k.startswith('_')})
+
+    async def sleep_ms(ms):
+        await asyncio.sleep(ms / 1000)
+
+    async def wait_for_ms(aw, ms):
+        return await asyncio.wait_for(aw, ms / 1000)
+
+    # Like uasyncio's stream: sleeps until obj is readable, then returns
+    # obj.read(n). Objects with a wait_readable() coroutine are woken by it,
+    # as MicroPython's poller would; others are polled.
+    class StreamReader:
+        def __init__(self, obj):
+            self.s = obj
+
+        async def read(self, n=-1):
+            while True:
+                data = self.s.read(n)
+                if data is not None:
+                    return data
+                if hasattr(self.s, 'wait_readable'):
+                    await self.s.wait_readable()
+                else:
+                    await asyncio.sleep(0.002)
+
+        async def readinto(self, buf):
+            while True:
+                n = self.s.readinto(buf)
+                if n is not None:
+                    return n
+                if hasattr(self.s, 'wait_readable'):
+                    await self.s.wait_readable()
+                else:
+                    await asyncio.sleep(0.002)
+
+    # Set from a pin IRQ; wait() consumes the flag.
+    class ThreadSafeFlag:
+        def __init__(self):
+            self._evt = asyncio.Event()
+
+        def set(self):
+            self._evt.set()
+
+        def clear(self):
+            self._evt.clear()
+
+        async def wait(self):
+            await self._evt.wait()
+            self._evt.clear()
+
+    m.sleep_ms = sleep_ms
+    m.wait_for_ms = wait_for_ms
+    m.StreamReader = StreamReader
+    m.ThreadSafeFlag = ThreadSafeFlag
+    return m
+
+
+def _micropython():
+    def passthrough(f):
+        return f
+    return _module('micropython', const=lambda x: x, native=passthrough,
+                   viper=passthrough, alloc_emergency_exception_buf=lambda n: None)
+
+
+def install():
+    if 'uasyncio' in sys.modules:
+        return
+    sys.modules['utime'] = _utime()
+    sys.modules['uasyncio'] = _uasyncio()
+    sys.modules['micropython'] = _micropython()
+    sys.modules['ustruct'] = struct
+    sys.modules['ubinascii'] = binascii
+    sys.modules['uerrno'] = errno
+    sys.modules['ujson'] = json
+    # The firmware also uses the MicroPython-only parts of time and gc.
+    for name in ('ticks_ms', 'ticks_us', 'ticks_diff', 'ticks_add'):
+        setattr(time, name, globals()[name])
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    gc.mem_free = lambda: 100000
+    gc.mem_alloc = lambda: tracemalloc.get_traced_memory()[0]
+    hardware.install()  # machine, network, onewire, ds18x20, ntptime
+    broker.install()  # usocket
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
@@ -0,0 +1,238 @@
+# sim.py Run the unmodified pool controller firmware on a Linux host
+# Released under the MIT licence.
+
+# A Simulation writes a conf.txt into a scratch directory, wires simulated EZO
+# pH/ORP circuits, pumps, a DS18B20, the tank load cell and WiFi to the fake
+# board, and executes
+# the repository's main.py exactly as the ESP32 would, against the in-process
+# broker.  A scenario coroutine runs alongside the control loop to drive and
+# observe it; the run ends when the scenario returns.
+#
+#   python3 Simulator/sim.py --duration 30     # watch the controller talk MQTT
+
+import argparse
+import asyncio
+import json
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+
+import shims
+
+shims.install()
+import broker as broker_mod
+import hardware
+
+ROOT = shims.ROOT
+
+CONF = {
+    'hostname': 'Pool_sim',
+    'ssid': 'sim_ssid',
+    'password': 'sim_password',
+    'mqtt_server': 'broker.sim',
+    'mqtt_port': '1883',
+    'mqtt_username': '',
+    'mqtt_pw': '',
+    'topic_sub': 'Pool',
+    'resp_pub': 'Pool/resp',
+    'ph_topic_pub': 'Pool/Ph',
+    'orp_topic_pub': 'Pool/ORP',
+    'keepalive_interval': 60,
+    'report_interval': 5,
+    'ph_uart_port': '2',
+    'ph_tx': '19',
+    'ph_rx': '21',
+    'orp_uart_port': '1',
+    'orp_tx': '16',
+    'orp_rx': '17',
+    'pump_1_pin': '18',
+    'pump_2_pin': '22',
+    'ph_ma_window': '10',
+    'orp_ma_window': '10',
+    'ph_pump': 1,
+    'orp_pump': 2,
+    'ds_pin': 27,
+    'load_cell_d_out_pin': '32',
+    'load_cell_pd_sck_pin': '33',
+}
+
+
+class Pool:
+    """
+    The water the probes are dipped in, and the chemical tank on the load cell
+    (`tank` grams, of which the tank pump uses `tank_use` per second).  Values
+    can be changed mid-run.
+    """
+    def __init__(self, ph=7.4, orp=700.0, temp=27.5, tank=20000.0, tank_use=0.5):
+        self.ph = ph
+        self.orp = orp
+        self.temp = temp
+        self.tank = tank
+        self.tank_use = tank_use
+
+
+LOAD_CELL_ZERO = 84000  # HX711 counts with nothing on the load cell
+LOAD_CELL_SCALE = 21.5  # counts per gram
+
+
+class _Finished(SystemExit):  # propagates out of the firmware's event loop
+    pass
+
+
+class Simulation:
+    def __init__(self, conf=None, pool=None, ezo_latency=hardware.EZOModule.READ_LATENCY,
+                 ezo_noise=0.0, broker_latency=0.0, probes=1, ezo_spikes=0.0):
+        self.conf = dict(CONF)
+        self.conf.update(conf or {})
+        self.pool = pool or Pool()
+        self.ezo_latency = ezo_latency
+        self.ezo_noise = ezo_noise
+        self.ezo_spikes = ezo_spikes  # fraction of readings that are spikes
+        self.broker_latency = broker_latency
+        self.probes = probes
+        self.board = hardware.board
+        self.broker = broker_mod.broker
+        self.t0 = None
+
+    def topic(self, key):
+        return self.conf[key].encode()
+
+    async def command(self, payload):
+        """Send a command to the controller as Home Assistant would."""
+        self.broker.publish(self.conf['topic_sub'], payload)
+
+    async def wait_for(self, predicate, timeout=30, poll=0.005):
+        t = time.monotonic()
+        while not predicate():
+            if time.monotonic() - t > timeout:
+                raise TimeoutError('simulation condition not met in {} s'.format(timeout))
+            await asyncio.sleep(poll)
+
+    async def wait_message(self, key, payload=None, after=0.0, timeout=30, prefix=None):
+        topic = self.topic(key)
+        found = []
+
+        def match():
+            for m in self.broker.messages:
+                if m.topic == topic and m.time >= after and (payload is None or m.payload == payload) \
+                        and (prefix is None or m.payload.startswith(prefix)):
+                    found.append(m)
+                    return True
+            return False
+
+        await self.wait_for(match, timeout)
+        return found[0]
+
+    def pin(self, key):
+        return self.board.pins[int(self.conf[key])]
+
+    def pump_seconds(self, key):
+        """Seconds the pump on conf[key] has been on so far."""
+        pin = self.board.pins.get(int(self.conf[key]))
+        total, on_at = 0.0, None
+        for t, v in pin.edges if pin else ():
+            if v:
+                on_at = t
+            elif on_at is not None:
+                total += t - on_at
+                on_at = None
+        return total + (time.monotonic() - on_at if on_at is not None else 0)
+
+    def _load_cell(self):
+        pump = 'pump_1_pin' if self.conf.get('tank_pump') == 'ph' else 'pump_2_pin'
+        grams = max(0.0, self.pool.tank - self.pool.tank_use * self.pump_seconds(pump))
+        return LOAD_CELL_ZERO + LOAD_CELL_SCALE * grams
+
+    def _setup(self):
+        hardware.reset_board()
+        self.broker.reset()
+        self.broker.latency = self.broker_latency
+        self.board.ssid = self.conf['ssid']
+        pool = self.pool
+        for port, signal, noise, spike in ((self.conf['ph_uart_port'], lambda: pool.ph, self.ezo_noise / 100, 1.0),
+                                           (self.conf['orp_uart_port'], lambda: pool.orp, self.ezo_noise, 150.0)):
+            hardware.EZOModule(int(port), signal, noise, read_latency=self.ezo_latency,
+                               spikes=self.ezo_spikes, spike_size=spike)
+        for i in range(self.probes):
+            self.board.ds18b20[bytes([0x28, i, 0, 0, 0, 0, 0, 0x42])] = pool.temp
+        if 'load_cell_d_out_pin' in self.conf:
+            hardware.HX711Module(int(self.conf['load_cell_d_out_pin']), int(self.conf['load_cell_pd_sck_pin']),
+                                 self._load_cell, noise=20)
+        # Fresh firmware modules for every run, as after a reboot.
+        for name, mod in list(sys.modules.items()):
+            f = getattr(mod, '__file__', None)
+            if f and os.path.dirname(os.path.abspath(f)) == ROOT:
+                del sys.modules[name]
+
+    def run(self, scenario, timeout=None):
+        """Run main.py with `await scenario(self)` alongside; return its result."""
+        self._setup()
+        cwd = os.getcwd()
+        platform = sys.platform
+        workdir = tempfile.mkdtemp(prefix='pool_sim_')
+        with open(os.path.join(workdir, 'conf.txt'), 'w') as f:
+            json.dump(self.conf, f)
+        table = os.path.join(ROOT, 'fc_table.bin')  # uploaded with the firmware
+        if os.path.exists(table):
+            shutil.copy(table, workdir)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        result = {}
+
+        async def driver():
+            self.t0 = time.monotonic()
+            try:
+                result['value'] = await asyncio.wait_for(scenario(self), timeout)
+            except BaseException as e:
+                result['error'] = e
+            raise _Finished()
+
+        task = loop.create_task(driver())
+        os.chdir(workdir)
+        sys.platform = 'esp32'
+        try:
+            runpy.run_path(os.path.join(ROOT, 'main.py'), run_name='__main__')
+        except _Finished:
+            pass
+        finally:
+            sys.platform = platform
+            os.chdir(cwd)
+            if task.done() and not task.cancelled():
+                task.exception()  # retrieved, so asyncio does not report it
+            for t in asyncio.all_tasks(loop):
+                t.cancel()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+            asyncio.set_event_loop(None)
+        if 'error' in result:
+            raise result['error']
+        if 'value' not in result:
+            raise RuntimeError('main.py returned before the scenario finished')
+        return result['value']
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Run main.py against simulated hardware')
+    ap.add_argument('--duration', type=float, default=30, help='seconds to run')
+    ap.add_argument('--report-interval', type=int, default=5)
+    ap.add_argument('--command', action='append', default=[],
+                    help='command to send once online, e.g. ph:on:2 (repeatable)')
+    args = ap.parse_args()
+    sim = Simulation({'report_interval': args.report_interval})
+
+    async def watch(sim):
+        sim.broker.listeners.append(
+            lambda m: print('[{:7.3f}] {} {}'.format(m.time - sim.t0, m.topic.decode(), m.payload.decode())))
+        await sim.wait_message('resp_pub', prefix=b'online')
+        for cmd in args.command:
+            await sim.command(cmd)
+        await asyncio.sleep(args.duration)
+
+    sim.run(watch)
+
+
+if __name__ == '__main__':
+    main()
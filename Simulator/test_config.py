@@ -0,0 +1,96 @@
+# test_config.py Checks of config.py's conf.txt cache on the host
+# Released under the MIT licence.
+
+# Run with python3 -m pytest Simulator/test_config.py, or directly.
+
+import json
+import os
+import sys
+import tempfile
+
+import shims
+
+shims.install()
+from sim import CONF
+
+sys.dont_write_bytecode = True  # a rewritten conf_cache.py must not be shadowed by its .pyc
+
+
+def _config(workdir):  # config.py freshly imported in workdir, as at boot
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)  # where conf_cache.py is imported from, like / on the board
+    sys.modules.pop('config', None)
+    sys.modules.pop('conf_cache', None)
+    try:
+        import config
+        return config
+    finally:
+        sys.path.remove(workdir)
+        os.chdir(cwd)
+
+
+def test_same_size_edit_is_not_served_from_cache():
+    workdir = tempfile.mkdtemp(prefix='pool_conf_')
+    path = os.path.join(workdir, 'conf.txt')
+    with open(path, 'w') as f:
+        json.dump(dict(CONF, ph_setpoint='7.4'), f)
+    st = os.stat(path)
+    assert _config(workdir).Dosing.ph_setpoint == 7.4
+    assert os.path.exists(os.path.join(workdir, 'conf_cache.py'))
+    with open(path, 'w') as f:  # same size, and the old time put back
+        json.dump(dict(CONF, ph_setpoint='7.2'), f)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert os.stat(path).st_size == st.st_size
+    assert _config(workdir).Dosing.ph_setpoint == 7.2
+
+
+def test_unchanged_conf_is_served_from_cache():
+    workdir = tempfile.mkdtemp(prefix='pool_conf_')
+    with open(os.path.join(workdir, 'conf.txt'), 'w') as f:
+        json.dump(CONF, f)
+    _config(workdir)
+    cache = os.path.join(workdir, 'conf_cache.py')
+    with open(cache) as f:
+        made = f.read()
+    with open(cache, 'w') as f:  # a cache hit returns VALUES without parsing conf.txt
+        f.write(made.replace("b'Pool/Ph'", "b'Pool/cached'"))
+    assert _config(workdir).ph_topic_pub == b'Pool/cached'
+
+
+def _refused(key, value, options):  # config.py stops on value for key, listing the options
+    workdir = tempfile.mkdtemp(prefix='pool_conf_')
+    with open(os.path.join(workdir, 'conf.txt'), 'w') as f:
+        json.dump(dict(CONF, **{key: value}), f)
+    try:
+        _config(workdir)
+    except ValueError as e:
+        assert key in str(e) and options in str(e)
+    else:
+        raise AssertionError('{} {} was accepted'.format(key, value))
+
+
+def test_unknown_publish_mode_is_refused():
+    _refused('publish_mode', 'topic', 'topics, state, both')
+
+
+def test_unknown_ezo_sample_mode_is_refused():
+    _refused('ezo_sample_mode', 'continous', 'repeat, continuous')
+
+
+def test_unknown_tank_pump_is_refused():
+    _refused('tank_pump', 'chlorine', 'ph, orp')
+
+
+def test_unknown_spool_drop_is_refused():
+    _refused('spool_drop', 'old', 'oldest, newest')
+
+
+if __name__ == '__main__':
+    test_same_size_edit_is_not_served_from_cache()
+    test_unchanged_conf_is_served_from_cache()
+    test_unknown_publish_mode_is_refused()
+    test_unknown_ezo_sample_mode_is_refused()
+    test_unknown_tank_pump_is_refused()
+    test_unknown_spool_drop_is_refused()
+    print('ok')
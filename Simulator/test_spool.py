@@ -0,0 +1,57 @@
+# test_spool.py Checks of spool.py's spill file on the host
+# Released under the MIT licence.
+
+# Run with python3 -m pytest Simulator/test_spool.py, or directly.
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from spool import Spool
+
+
+def _replay(spool):  # values in the order the forwarder would send them
+    out = []
+    while len(spool):
+        batch = spool.peek(3)
+        out += [int(v) for _, _, v in batch]
+        spool.commit(len(batch))
+    return out
+
+
+def test_full_file_drops_oldest_without_a_gap():
+    path = os.path.join(tempfile.mkdtemp(prefix='pool_spool_'), 'spool.bin')
+    spool = Spool(4, path, 90, 'oldest')  # 4 records in RAM, 10 in the file
+    for i in range(20):
+        spool.append(i, 0, i)
+    assert _replay(spool) == list(range(6, 20))
+    assert spool.dropped == 6
+
+
+def test_drops_during_a_replay_are_not_committed_twice():
+    path = os.path.join(tempfile.mkdtemp(prefix='pool_spool_'), 'spool.bin')
+    spool = Spool(4, path, 90, 'oldest')
+    for i in range(14):
+        spool.append(i, 0, i)
+    batch = spool.peek(3)
+    for i in range(14, 30):  # still sampling while the batch is published
+        spool.append(i, 0, i)
+    spool.commit(len(batch))
+    assert _replay(spool) == list(range(18, 30))
+
+
+def test_full_file_drops_newest():
+    path = os.path.join(tempfile.mkdtemp(prefix='pool_spool_'), 'spool.bin')
+    spool = Spool(4, path, 90, 'newest')
+    for i in range(20):
+        spool.append(i, 0, i)
+    assert _replay(spool) == list(range(12))
+    assert spool.dropped == 8
+
+
+if __name__ == '__main__':
+    test_full_file_drops_oldest_without_a_gap()
+    test_drops_during_a_replay_are_not_committed_twice()
+    test_full_file_drops_newest()
+    print('ok')
@@ -0,0 +1,79 @@
+# chlorine.py Free chlorine from pH and ORP for pool controller v3
+# (C) Copyright Stefan Murry 2020.
+# Released under the MIT licence.
+
+# The ORP-FC chart, as made into fc_table.bin by Ph-ORP Chart/chart_loader.py,
+# read straight into three arrays: ORP in tenths of a mV, pH in thousandths and
+# free chlorine in thousandths of a ppm (0xffff where the chart is blank).  The
+# 60 x 12 chart takes 1.6 kB.  A lookup bisects both axes and interpolates
+# bilinearly between the four surrounding chart values in integers, as pool_fc.py
+# does in floating point in Home Assistant, so FC is known without Home
+# Assistant and costs no float work beyond scaling the two readings.
+
+import struct
+from array import array
+
+MAGIC = b'OFCT'
+VERSION = 1
+HEADER = '<4sBBHH' # then padding to HEADER_SIZE
+HEADER_SIZE = 16
+ORP_SCALE = 10
+PH_SCALE = 1000
+FC_SCALE = 1000
+BLANK = 0xffff
+
+
+def _array(f, typecode, n):  # n items of typecode read from f, little endian as on the ESP32
+    a = array(typecode, (0 for _ in range(n)))
+    if f.readinto(a) != 2 * n:
+        raise ValueError('FC table truncated')
+    return a
+
+
+def _below(a, x):  # index of the chart interval holding x
+    lo, hi = 0, len(a) - 2
+    while lo < hi:
+        mid = (lo + hi + 1) >> 1
+        if a[mid] <= x:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class FcTable:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, version, _, n_orp, n_ph = struct.unpack(HEADER, f.read(HEADER_SIZE)[:10])
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{} is not an FC table'.format(path))
+            self.orp = _array(f, 'h', n_orp)
+            self.ph = _array(f, 'h', n_ph)
+            self.fc = _array(f, 'H', n_orp * n_ph)
+
+    # FC in thousandths of a ppm for a pH and ORP (mV), or None off the chart or
+    # next to a blank cell.
+    def lookup(self, ph, orp):
+        x = int(orp * ORP_SCALE + 0.5)
+        y = int(ph * PH_SCALE + 0.5)
+        xs, ys = self.orp, self.ph
+        if not (xs[0] <= x <= xs[-1] and ys[0] <= y <= ys[-1]):
+            return None
+        i = _below(xs, x)
+        j = _below(ys, y)
+        dx = xs[i + 1] - xs[i]
+        dy = ys[j + 1] - ys[j]
+        tx = x - xs[i]
+        ty = y - ys[j]
+        n = len(ys)
+        k = i * n + j
+        fc = self.fc
+        total = 0
+        for v, w in ((fc[k], (dx - tx) * (dy - ty)), (fc[k + 1], (dx - tx) * ty),
+                     (fc[k + n], tx * (dy - ty)), (fc[k + n + 1], tx * ty)):
+            if w:
+                if v == BLANK:
+                    return None
+                total += v * w
+        d = dx * dy
+        return (total + d // 2) // d
@@ -0,0 +1,124 @@
+# commands.py Command router for pool controller v3
+# (C) Copyright Stefan Murry 2020.
+# Released under the MIT licence.
+
+# Commands arrive on topic_sub as '<target>:<verb>[:<argument>]', e.g. ph:on:30,
+# or as a bare target such as 'status'.  Each payload is parsed once, against
+# the targets and routes declared with target() and route(), into a record
+# (handler, target value, argument, slot) and queued.  run() dispatches the
+# queue in order, starting each handler as its own task, but never more than a
+# target's limit of them at once; routes declared with exclusive=False (off,
+# done) bypass the limit so they are never stuck behind a long running command.
+# The queue is bounded, and a command identical to one still waiting is
+# dropped, so a flood of messages costs a parse and a comparison each.
+
+import uasyncio as asyncio
+
+
+class CommandError(ValueError):  # reason is published back on resp_pub
+    pass
+
+
+# Argument types
+def seconds(arg):
+    v = int(arg)
+    if v < 0:
+        raise ValueError
+    return v
+
+
+def grams(arg):
+    v = int(arg)
+    if v <= 0:
+        raise ValueError
+    return v
+
+
+class Router:
+    def __init__(self, size):
+        self._targets = {}  # name: target value passed to its handlers
+        self._routes = {}  # target name: {verb: (handler, argument type, default, exclusive)}
+        self._limits = {}  # target name: handlers allowed to run at once
+        self._busy = {}  # target name: handlers running
+        self._queue = []
+        self._size = size
+        self._evt = asyncio.Event()
+        self.dropped = 0
+
+    def target(self, name, value=None, limit=1):
+        name = name.encode()
+        self._targets[name] = value
+        self._routes[name] = {}
+        self._limits[name] = limit
+        self._busy[name] = 0
+
+    # arg is the argument type (a function of the argument's bytes that raises
+    # ValueError if it is invalid), or None if the command takes no argument.
+    # If the argument is left out, default is used; a default of None makes it
+    # mandatory.
+    def route(self, target, verb, handler, arg=None, default=None, exclusive=True):
+        self._routes[target.encode()][verb.encode()] = (handler, arg, default, exclusive)
+
+    def parse(self, msg):
+        parts = bytes(msg).lower().split(b':')
+        if len(parts) > 3 or parts[0] not in self._routes:
+            raise CommandError('unknown command')
+        route = self._routes[parts[0]].get(parts[1] if len(parts) > 1 else b'')
+        if route is None:
+            raise CommandError('unknown command')
+        handler, conv, default, exclusive = route
+        if conv is None:
+            if len(parts) > 2:
+                raise CommandError('bad argument')
+            arg = None
+        elif len(parts) > 2:
+            try:
+                arg = conv(parts[2])
+            except ValueError:
+                raise CommandError('bad argument')
+        elif default is None:
+            raise CommandError('missing argument')
+        else:
+            arg = default
+        return (handler, self._targets[parts[0]], arg, parts[0] if exclusive else None)
+
+    # Called from the MQTT callback, so it never blocks.  Raises CommandError
+    # if msg is malformed or the queue is full.
+    def submit(self, msg):
+        rec = self.parse(msg)
+        if rec in self._queue:
+            return
+        if len(self._queue) >= self._size:
+            self.dropped += 1
+            raise CommandError('command queue full')
+        self._queue.append(rec)
+        self._evt.set()
+
+    def _take(self):  # the oldest queued record whose target has a free slot
+        for i in range(len(self._queue)):
+            slot = self._queue[i][3]
+            if slot is None or self._busy[slot] < self._limits[slot]:
+                return self._queue.pop(i)
+        return None
+
+    async def _call(self, handler, value, arg, slot):
+        try:
+            await handler(value, arg)
+        except Exception as e:
+            print('command failed: {}'.format(e))
+        finally:
+            if slot is not None:
+                self._busy[slot] -= 1
+                self._evt.set()
+
+    async def run(self):
+        while True:
+            rec = self._take()
+            if rec is None:
+                self._evt.clear()
+                await self._evt.wait()
+                continue
+            handler, value, arg, slot = rec
+            if slot is not None:
+                self._busy[slot] += 1
+            asyncio.create_task(self._call(handler, value, arg, slot))
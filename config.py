@@ -1,97 +1,210 @@
 # config.py Local configuration for pool controller v3
 from sys import platform
 from mqtt_as import config
+from collections import namedtuple
 import json
-import ubinascii
-import machine, onewire, ds18x20
-import scales
-
-
-# Load configuration from file
-with open (r'conf.txt', 'rt') as File_object:     # Open conf.txt for reading text
-    conf = File_object.read()                   # Read the entire file into a variable
-
-d = json.loads(conf)
+import sys
+from ubinascii import crc32
+
+# conf.txt is read once, in a single pass over _SCHEMA, into one read-only
+# namedtuple per section (Sensor, Pump, Dosing, Tank), so the values are
+# converted and checked at boot rather than where they are used.  The converted
+# values are also saved to conf_cache.py, stamped with conf.txt's size and CRC32
+# and the schema they were made with; while neither changes, later boots import
+# that instead of parsing and converting the JSON again.  The stamp is taken
+# from the file's bytes rather than its time, which an unset RTC or a same-size
+# edit within the filesystem's time resolution would leave unchanged.  Nothing here touches
+# the hardware: pins are made by the code that drives them.
+
+_CONF = 'conf.txt'
+_CACHE = 'conf_cache.py'
+_REQUIRED = object()  # default of settings conf.txt must give
+
+
+def _topic(v):
+    return v.encode('utf-8')
+
+
+def _on(v):
+    return v == 'on'
+
+
+class _choice:  # a setting that must be one of options
+    def __init__(self, *options):
+        self.options = options
+
+    def __call__(self, v):
+        if v not in self.options:
+            raise ValueError(v)
+        return v
+
+
+_SCHEMA = (
+    # section, attribute, conf.txt key, type, default
+    ('main', 'topic_sub', 'topic_sub', _topic, _REQUIRED),
+    ('main', 'ph_topic_pub', 'ph_topic_pub', _topic, _REQUIRED),
+    ('main', 'orp_topic_pub', 'orp_topic_pub', _topic, _REQUIRED),
+    ('main', 'resp_pub', 'resp_pub', _topic, _REQUIRED),
+    ('main', 'state_topic_pub', 'state_topic_pub', _topic, b'Pool/state'), # one JSON message per report cycle
+    ('main', 'fc_topic_pub', 'fc_topic_pub', _topic, b'Pool/FC'), # free chlorine estimated from the moving averages
+    ('main', 'temp_topic_pub', 'temp_topic_pub', _topic, b'Pool/temp'), # water temperature every temp_interval
+    ('main', 'publish_mode', 'publish_mode', _choice('topics', 'state', 'both'), 'topics'),
+    ('main', 'report_interval', 'report_interval', int, _REQUIRED),
+    ('mqtt', 'server', 'mqtt_server', str, _REQUIRED), # MQTT Broker Address
+    ('mqtt', 'port', 'mqtt_port', int, _REQUIRED), # MQTT Broker Port
+    ('mqtt', 'user', 'mqtt_username', str, _REQUIRED), # MQTT Broker Username
+    ('mqtt', 'password', 'mqtt_pw', str, _REQUIRED), # MQTT Broker Password
+    ('mqtt', 'ssid', 'ssid', str, _REQUIRED), # WiFi SSID
+    ('mqtt', 'wifi_pw', 'password', str, _REQUIRED), # Wifi Password
+    ('mqtt', 'keepalive', 'keepalive_interval', int, _REQUIRED),
+    ('mqtt', 'hostname', 'hostname', str, _REQUIRED), # configure human-readable Wifi hostname
+    ('Sensor', 'ph_uart_port', 'ph_uart_port', int, _REQUIRED), # UART port on the ESP32 used for the PH sensor
+    ('Sensor', 'ph_tx', 'ph_tx', int, _REQUIRED), # PH sensor Tx pin
+    ('Sensor', 'ph_rx', 'ph_rx', int, _REQUIRED), # PH sensor Rx pin
+    ('Sensor', 'orp_uart_port', 'orp_uart_port', int, _REQUIRED), # UART port on the ESP32 used for the ORP sensor
+    ('Sensor', 'orp_tx', 'orp_tx', int, _REQUIRED), # ORP sensor Tx pin
+    ('Sensor', 'orp_rx', 'orp_rx', int, _REQUIRED), # ORP sensor Rx pin
+    ('Sensor', 'report_interval', 'report_interval', int, _REQUIRED), # how often are Ph and ORP values sent over MQTT (sec)
+    ('Sensor', 'ph_ma_window', 'ph_ma_window', int, _REQUIRED), # how many datapoints in the moving average window
+    ('Sensor', 'orp_ma_window', 'orp_ma_window', int, _REQUIRED),
+    ('Sensor', 'ezo_read_timeout_ms', 'ezo_read_timeout_ms', int, 1500), # deadline for an EZO 'R' reply
+    ('Sensor', 'ezo_samples', 'ezo_samples', int, 3), # readings per probe per report_interval, filtered into one value
+    ('Sensor', 'ezo_sample_mode', 'ezo_sample_mode', _choice('repeat', 'continuous'), 'repeat'), # R commands or (C,1) reading
+    ('Sensor', 'ezo_trim', 'ezo_trim', int, None), # readings dropped from each end before averaging
+    ('Sensor', 'ph_min', 'ph_min', float, 0.0), # readings outside the probe's range are discarded
+    ('Sensor', 'ph_max', 'ph_max', float, 14.0),
+    ('Sensor', 'orp_min', 'orp_min', float, -1019.9),
+    ('Sensor', 'orp_max', 'orp_max', float, 1019.9),
+    ('Sensor', 'outlier_sigmas', 'outlier_sigmas', float, 4.0), # discard values this many std devs from the moving average, 0 disables
+    ('Sensor', 'ph_outlier_floor', 'ph_outlier_floor', float, 0.05), # smallest deviation ever treated as an outlier
+    ('Sensor', 'orp_outlier_floor', 'orp_outlier_floor', float, 10.0),
+    ('Sensor', 'outlier_max_rejects', 'outlier_max_rejects', int, 3), # accept anyway after this many in a row
+    ('Sensor', 'sample_queue_size', 'sample_queue_size', int, 8), # readings held while the publisher catches up
+    ('Sensor', 'spool_size', 'spool_size', int, 720), # readings kept in RAM during an outage
+    ('Sensor', 'spool_file', 'spool_file', str, 'spool.bin'), # flash file a full RAM spool spills to
+    ('Sensor', 'spool_file_max', 'spool_file_max', int, 0), # max bytes of spill file, 0 disables spilling
+    ('Sensor', 'spool_drop', 'spool_drop', _choice('oldest', 'newest'), 'oldest'), # readings dropped when full
+    ('Sensor', 'spool_batch', 'spool_batch', int, 32), # readings replayed per batch after reconnect
+    ('Sensor', 'fc_table', 'fc_table', str, 'fc_table.bin'), # ORP-FC chart for the free chlorine estimate, '' to disable
+    ('Sensor', 'command_queue_size', 'command_queue_size', int, 8), # commands waiting to run before more are refused
+    ('Sensor', 'load_cell_d_out_pin', 'load_cell_d_out_pin', int, _REQUIRED),
+    ('Sensor', 'load_cell_pd_sck_pin', 'load_cell_pd_sck_pin', int, _REQUIRED),
+    ('Sensor', 'ds_pin', 'ds_pin', int, _REQUIRED), # DS18B20 one-wire bus pin
+    ('Sensor', 'temp_interval', 'temp_interval', int, 60), # seconds between temperature conversions, 0 disables
+    ('Pump', 'pump_1_pin', 'pump_1_pin', int, _REQUIRED),
+    ('Pump', 'pump_2_pin', 'pump_2_pin', int, _REQUIRED),
+    ('Pump', 'PH_PUMP', 'ph_pump', int, _REQUIRED),
+    ('Pump', 'ORP_PUMP', 'orp_pump', int, _REQUIRED),
+    ('Pump', 'ph_daily_max', 'ph_pump_daily_max', int, 0), # seconds the pH pump may run per day, 0 for no limit
+    ('Pump', 'orp_daily_max', 'orp_pump_daily_max', int, 0), # seconds the ORP pump may run per day, 0 for no limit
+    ('Pump', 'min_off', 'pump_min_off', int, 0), # seconds a pump rests between doses
+    ('Dosing', 'enabled', 'dosing', _on, False), # closed loop dosing from the moving averages
+    ('Dosing', 'interval', 'dosing_interval', int, 600), # seconds between dosing decisions
+    ('Dosing', 'ph_setpoint', 'ph_setpoint', float, 7.4),
+    ('Dosing', 'ph_kp', 'ph_kp', float, 1000.0), # pump seconds per pH of error
+    ('Dosing', 'ph_ki', 'ph_ki', float, 0.01), # pump seconds per pH of error per second
+    ('Dosing', 'ph_kd', 'ph_kd', float, 0.0),
+    ('Dosing', 'ph_deadband', 'ph_deadband', float, 0.05),
+    ('Dosing', 'ph_max_pulse', 'ph_max_pulse', int, 180), # longest dose per interval (sec)
+    ('Dosing', 'orp_setpoint', 'orp_setpoint', float, 700.0),
+    ('Dosing', 'orp_kp', 'orp_kp', float, 2.0), # pump seconds per mV of error
+    ('Dosing', 'orp_ki', 'orp_ki', float, 0.00005),
+    ('Dosing', 'orp_kd', 'orp_kd', float, 0.0),
+    ('Dosing', 'orp_deadband', 'orp_deadband', float, 10.0),
+    ('Dosing', 'orp_max_pulse', 'orp_max_pulse', int, 180),
+    ('Tank', 'enabled', 'tank', _on, False), # weigh the chemical tank on the load cell
+    ('Tank', 'pump', 'tank_pump', _choice('ph', 'orp'), 'orp'), # the pump that draws from the tank
+    ('Tank', 'topic_pub', 'tank_topic_pub', _topic, b'Pool/tank'),
+    ('Tank', 'interval', 'tank_interval', int, 300), # seconds between weighings
+    ('Tank', 'reads', 'tank_reads', int, 5), # HX711 conversions per weighing
+    ('Tank', 'window', 'tank_window', int, 6), # weighings in the moving average
+    ('Tank', 'refill_g', 'tank_refill_g', int, 500), # a jump this big (grams) restarts the average
+    ('Tank', 'file', 'tank_file', str, 'tank.json'), # tare, scale factor and consumption rate
+)
+
+
+def _parse(d):
+    values = []
+    for section, name, key, conv, default in _SCHEMA:
+        if key in d:
+            try:
+                values.append(conv(d[key]))
+            except (TypeError, ValueError):
+                hint = ' (one of {})'.format(', '.join(conv.options)) if isinstance(conv, _choice) else ''
+                raise ValueError('{}: bad value for {}: {}{}'.format(_CONF, key, d[key], hint))
+        elif default is _REQUIRED:
+            raise ValueError('{}: {} is missing'.format(_CONF, key))
+        else:
+            values.append(default)
+    return tuple(values)
+
+
+def _load():
+    with open(_CONF, 'rb') as f:
+        data = f.read()
+    stamp = (len(data), crc32(data))
+    schema = repr(tuple((key, None if default is _REQUIRED else default, getattr(conv, 'options', None))
+                        for _, _, key, conv, default in _SCHEMA)) # options, so a cached value is checked again
+    try:
+        from conf_cache import STAMP, SCHEMA, VALUES
+        del sys.modules['conf_cache']
+        if STAMP == stamp and SCHEMA == schema:
+            return VALUES
+    except (ImportError, SyntaxError, ValueError):
+        pass
+    values = _parse(json.loads(data))
+    try:
+        with open(_CACHE, 'w') as f:
+            f.write('# Made by config.py from {}; delete it to have it made again\n'.format(_CONF))
+            f.write('STAMP = {!r}\nSCHEMA = {!r}\nVALUES = {!r}\n'.format(stamp, schema, values))
+    except OSError:
+        pass
+    return values
+
+
+def _sections(values):
+    fields = {}
+    for i in range(len(_SCHEMA)):
+        section, name = _SCHEMA[i][0], _SCHEMA[i][1]
+        if section not in fields:
+            fields[section] = ([], [])
+        fields[section][0].append(name)
+        fields[section][1].append(values[i])
+    return {s: namedtuple(s, f[0])(*f[1]) for s, f in fields.items()}
+
+
+_s = _sections(_load())
+Main, Sensor, Pump, Dosing, Tank = _s['main'], _s['Sensor'], _s['Pump'], _s['Dosing'], _s['Tank']
 
 # Set up config variables
-topic_sub = d['topic_sub'].encode('utf-8')
-ph_topic_pub = d['ph_topic_pub'].encode('utf-8')
-orp_topic_pub = d['orp_topic_pub'].encode('utf-8')
-resp_pub = d['resp_pub'].encode('utf-8')
-report_interval = int(d['report_interval'])
-
-config['server'] = d['mqtt_server']  # MQTT Broker Address
-config['port'] = int(d['mqtt_port']) #MQTT Broker Port
-config['user'] = d['mqtt_username'] # MQTT Broker Username
-config['password'] = d['mqtt_pw'] #MQTT Broker Password
-config['ssid'] = d['ssid'] #WiFi SSID
-config['wifi_pw'] = d['password'] # Wifi Password
-config['keepalive'] = int(d['keepalive_interval'])
-config['hostname'] = d['hostname'] # configure human-readable Wifi hostname
-
-class Sensor:
-    with open (r'conf.txt', 'rt') as File_object:     # Open conf.txt for reading text
-        conf = File_object.read()                   # Read the entire file into a variable
-
-    global d
-    d = json.loads(conf)
-
-    ph_uart_port=int(d['ph_uart_port']) # UART port on the ESP32 used for the PH sensor
-    ph_tx = int(d['ph_tx']) # PH sensor Tx pin
-    ph_rx = int(d['ph_rx']) # PH sensor Rx pin
-    orp_uart_port=int(d['orp_uart_port']) # UART port on the ESP32 used for the ORP sensor
-    orp_tx = int(d['orp_tx']) # ORP sensor Tx pin
-    orp_rx = int(d['orp_rx']) # ORP sensor Rx pin
-    repl_button = machine.Pin(0, machine.Pin.IN, machine.Pin.PULL_UP) #define a button which will exit the program
-    report_interval = int(d['report_interval']) # how often are Ph and ORP values sent over MQTT (sec)
-    ph_ma_window = int(d['ph_ma_window']) # how many datapoints in the moving average window
-    orp_ma_window = int(d['orp_ma_window'])
-    load_cell_d_out_pin = int(d['load_cell_d_out_pin'])
-    load_cell_pd_sck_pin = int(d['load_cell_pd_sck_pin'])
-
-class Pump:
-    global d
-    pump_1_pin=machine.Pin(int(d['pump_1_pin']), machine.Pin.OUT)
-    pump_2_pin=machine.Pin(int(d['pump_2_pin']), machine.Pin.OUT)
-    PH_PUMP = int(d['ph_pump'])
-    ORP_PUMP = int(d['orp_pump'])
-
-class Temp_sensor():
-    global d
-    def __init__(self):
-        self.ds_pin = machine.Pin(int(d['ds_pin']))
-        self.ds_sensor = ds18x20.DS18X20(onewire.OneWire(self.ds_pin))
-
-    def scan(self):
-        roms=self.ds_sensor.scan()
-        print('Found DS devices: {}'.format(roms))
-        return roms
-
-    def convert_temp(self):
-        c=self.ds_sensor.convert_temp()
-        print(c)
-        return c
-
-    def read_temp(self, rom):
-        c = self.ds_sensor.read_temp(rom)
-        print(c)
-        return c
-
-
-
+topic_sub = Main.topic_sub
+ph_topic_pub = Main.ph_topic_pub
+orp_topic_pub = Main.orp_topic_pub
+resp_pub = Main.resp_pub
+state_topic_pub = Main.state_topic_pub
+fc_topic_pub = Main.fc_topic_pub
+temp_topic_pub = Main.temp_topic_pub
+publish_mode = Main.publish_mode
+report_interval = Main.report_interval
+
+config.update(zip(('server', 'port', 'user', 'password', 'ssid', 'wifi_pw', 'keepalive', 'hostname'), _s['mqtt']))
+del _s
 
 # I haven't tested with platforms other than ESP32, but the following pin definitions for the LEDs
 # are known to vary across the different platforms.
 
 if platform == 'esp8266' or platform == 'esp32' or platform == 'esp32_LoBo':
-    from machine import Pin
-    def ledfunc(pin):
-        pin = pin
+    def ledfunc(pin_id, init):
+        pin = None
         def func(v):
+            nonlocal pin
+            if pin is None:  # made on first use
+                from machine import Pin
+                pin = Pin(pin_id, Pin.OUT, value = init)
             pin(not v)  # Active low on ESP8266
         return func
-    wifi_led = ledfunc(Pin(26, Pin.OUT, value = 0))  # Red LED for connected to broker
-    blue_led = ledfunc(Pin(2, Pin.OUT, value = 1))  # WiFi connected or message received
+    wifi_led = ledfunc(26, 0)  # Red LED for connected to broker
+    blue_led = ledfunc(2, 1)  # WiFi connected or message received
 elif platform == 'pyboard':
     from pyb import LED
     def ledfunc(led, init):
@@ -0,0 +1,106 @@
+# dosing.py Closed loop pH/ORP dosing for pool controller v3
+# (C) Copyright Stefan Murry 2020.
+# Released under the MIT licence.
+
+# Pulse-width PID control on the moving averages.  Every `interval` seconds a
+# Doser turns the error of its probe's moving average into seconds of pump run
+# time, capped at max_pulse, and hands it to the pump's PumpScheduler.  It only
+# needs the sampler and the pump, so dosing carries on with the broker down.
+#
+# Pool water responds slowly (the dose has to circulate before the probe sees
+# it), so the integral term does most of the work and is protected against
+# windup: it only integrates near the setpoint, stops growing while the output
+# is pinned at either limit and is held at zero or above, since a pump can
+# only ever add chemical.  Within the
+# deadband the proportional and derivative terms are ignored, so probe noise
+# does not pulse the pump, while the integral keeps supplying the steady dose
+# the pool consumes.
+
+import uasyncio as asyncio
+
+RAISES = 1  # pump raises the value (bleach and ORP)
+LOWERS = -1  # pump lowers the value (acid and pH)
+INTEGRAL_BAND = 4  # integrate only within this many deadbands of the setpoint
+
+
+class PID:
+    def __init__(self, setpoint, kp, ki=0.0, kd=0.0, deadband=0.0, max_pulse=60,
+                 min_pulse=1, direction=RAISES):
+        self.setpoint = setpoint
+        self.kp = kp  # pump seconds per unit of error
+        self.ki = ki  # pump seconds per unit of error per second
+        self.kd = kd  # pump seconds per unit of change per second
+        self.deadband = deadband
+        self.max_pulse = max_pulse
+        self.min_pulse = min_pulse  # shorter pulses are not worth switching the pump for
+        self.direction = direction
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self._last = None
+
+    # Seconds to run the pump for, given the latest value and the seconds since
+    # the previous update.
+    def update(self, value, dt):
+        err = (self.setpoint - value) * self.direction  # > 0 when a dose is needed
+        # derivative on the measurement, so setpoint changes do not kick
+        slope = 0.0 if self._last is None else (self._last - value) * self.direction / dt
+        self._last = value
+        integral = self.integral
+        if -INTEGRAL_BAND * self.deadband < err < INTEGRAL_BAND * self.deadband:
+            integral += err * dt
+        out = self.ki * integral
+        if not -self.deadband < err < self.deadband:
+            out += self.kp * err + self.kd * slope
+        if 0 < out < self.max_pulse or (out >= self.max_pulse and err < 0) or (out <= 0 and err > 0):
+            self.integral = integral  # only integrate while it can still change the output
+        if self.ki:
+            self.integral = min(max(self.integral, 0.0), self.max_pulse / self.ki)
+        if out < self.min_pulse:
+            return 0
+        return min(out, self.max_pulse)
+
+
+class Doser:
+    def __init__(self, pid, stats, pump, interval, window):
+        self.pid = pid
+        self.stats = stats  # RollingStats the sampler feeds
+        self.pump = pump  # PumpScheduler
+        self.interval = interval
+        self._window = window
+        self._ready_at = window  # stats.count at which the average is trustworthy again
+        self._seen = 0
+        self.paused = False
+        self.last_pulse = 0
+
+    # Stop dosing, e.g. while the probe is in calibration solution.  Readings
+    # taken meanwhile are flushed out of the average before dosing resumes.
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._ready_at = self.stats.count + self._window
+        self.pid.reset()
+
+    def step(self):  # one control decision; returns the pulse requested
+        count = self.stats.count
+        fresh = count != self._seen
+        self._seen = count
+        if self.paused or not fresh or count < self._ready_at:
+            return 0  # no new readings (probe failing) or the average is not ready
+        pulse = self.pid.update(self.stats.mean, self.interval)
+        if pulse:
+            pulse = self.pump.request(pulse)
+        self.last_pulse = pulse
+        return pulse
+
+    def as_dict(self):
+        return {'setpoint': self.pid.setpoint, 'pulse': round(self.last_pulse, 1),
+                'integral': round(self.pid.integral, 1), 'paused': self.paused}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.step()
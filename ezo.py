@@ -0,0 +1,140 @@
+# ezo.py Atlas Scientific EZO UART protocol for pool controller v3
+# (C) Copyright Stefan Murry 2020.
+# Released under the MIT licence.
+
+# The EZO circuits answer every command with an optional '\r' terminated data
+# line followed by a '\r' terminated status line ('*OK', '*ER', ...).  Rather
+# than sleeping a fixed time and reading whatever is in the UART buffer, the
+# reader below awaits those lines on a uasyncio stream, so a command costs only
+# as long as the module actually takes to answer.  read_many() takes several
+# readings per report cycle for the filters in rolling.py.
+
+import uasyncio as asyncio
+
+
+class EZOError(Exception):
+    pass
+
+
+class EZOTimeout(EZOError):  # no complete answer before the deadline
+    pass
+
+
+class EZOCommandError(EZOError):  # module answered *ER, *OV or *UV
+    pass
+
+
+class EZOReadingError(EZOError):  # answer could not be parsed as a reading
+    pass
+
+
+# Unsolicited status lines the module emits on power up, reset or wake.
+_EVENTS = (b'*RS', b'*RE', b'*SL', b'*WA')
+
+
+class EZO:
+    READ_TIMEOUT_MS = 1500  # 'R' takes about 900 ms
+    COMMAND_TIMEOUT_MS = 600  # most other commands take 300 ms
+
+    def __init__(self, uart, name='EZO', read_timeout_ms=READ_TIMEOUT_MS,
+                 command_timeout_ms=COMMAND_TIMEOUT_MS):
+        self._uart = uart
+        self._sreader = asyncio.StreamReader(uart)
+        self._buf = b''
+        self.name = name
+        self.read_timeout_ms = read_timeout_ms
+        self.command_timeout_ms = command_timeout_ms
+        self.lock = asyncio.Lock()  # one command in flight per module
+
+    def __repr__(self):
+        return 'EZO {}'.format(self.name)
+
+    async def _readline(self):
+        while True:
+            i = self._buf.find(b'\r')
+            if i >= 0:
+                line = self._buf[:i]
+                self._buf = self._buf[i + 1:]
+                return line
+            self._buf += await self._sreader.read(32)
+
+    async def _response(self):
+        data = None
+        while True:
+            line = await self._readline()
+            if not line or line in _EVENTS:
+                continue
+            if line == b'*OK':
+                return data
+            if line[:1] == b'*':
+                raise EZOCommandError('{} answered {}'.format(self.name, line.decode()))
+            data = line
+
+    # Send a command and return the data line of the answer (None if the command
+    # only returns a status).  Raises EZOTimeout if the module does not finish
+    # answering within timeout_ms.
+    async def command(self, cmd, timeout_ms=None):
+        if timeout_ms is None:
+            timeout_ms = self.command_timeout_ms
+        async with self.lock:
+            self._uart.read()  # discard anything stale left in the UART buffer
+            self._buf = b''
+            self._uart.write(cmd + '\r')
+            try:
+                data = await asyncio.wait_for_ms(self._response(), timeout_ms)
+            except asyncio.TimeoutError:
+                raise EZOTimeout('{} timeout on {}'.format(self.name, cmd))
+        return data.decode() if data is not None else None
+
+    async def read(self):
+        data = await self.command('R', self.read_timeout_ms)
+        try:
+            return float(data)
+        except (TypeError, ValueError):
+            raise EZOReadingError('{} bad reading {}'.format(self.name, data))
+
+    # Take k readings as fast as the module produces them and pass each to
+    # add(value): k 'R' commands back to back or, with continuous=True, the
+    # first k lines of a 'C,1' stream, which is then stopped with 'C,0'.
+    # Unparseable readings are skipped.  Returns how many were taken; raises
+    # EZOTimeout if the module stops answering before any were.
+    async def read_many(self, k, add, continuous=False):
+        n = 0
+        if not continuous:
+            for _ in range(k):
+                try:
+                    add(await self.read())
+                    n += 1
+                except EZOReadingError:
+                    pass
+                except EZOTimeout:
+                    if not n:
+                        raise
+                    break
+            return n
+        async with self.lock:
+            self._uart.read()
+            self._buf = b''
+            self._uart.write('C,1\r')
+            try:
+                while n < k:
+                    try:
+                        line = await asyncio.wait_for_ms(self._readline(), self.read_timeout_ms)
+                    except asyncio.TimeoutError:
+                        if not n:
+                            raise EZOTimeout('{} timeout on C,1'.format(self.name))
+                        break
+                    if not line or line[:1] == b'*':  # the *OK for C,1, or an event
+                        continue
+                    try:
+                        add(float(line))
+                        n += 1
+                    except ValueError:
+                        pass
+            finally:
+                self._uart.write('C,0\r')
+                try:  # a last reading may come before its *OK
+                    await asyncio.wait_for_ms(self._response(), self.command_timeout_ms)
+                except (asyncio.TimeoutError, EZOError):
+                    pass
+        return n
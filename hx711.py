@@ -1,6 +1,13 @@
-from utime import sleep_us, time
+from utime import sleep_us, time, ticks_ms, ticks_diff
 from machine import Pin
 from micropython import const
+import micropython
+import uasyncio as asyncio
+
+try:
+    from uasyncio import ThreadSafeFlag  # MicroPython 1.15 or later
+except ImportError:
+    ThreadSafeFlag = None
 
 
 class HX711Exception(Exception):
@@ -15,6 +22,28 @@ class DeviceIsNotReady(HX711Exception):
     pass
 
 
+@micropython.native
+def _shift_in(sck, dout, bits):
+    """
+    Clocks `bits` bits out of the HX711, MSB first.  sck and dout are
+    the bound value methods of the pins, so the loop does no attribute
+    lookups and PD_SCK stays high well under the 60 us power down limit.
+    """
+    data = 0
+    for _ in range(bits):
+        sck(1)
+        sck(0)
+        data = data << 1 | dout()
+    return data
+
+
+@micropython.native
+def _pulse(sck, n):
+    for _ in range(n):
+        sck(1)
+        sck(0)
+
+
 class HX711(object):
     """
     Micropython driver for Avia Semiconductor's HX711
@@ -29,10 +58,14 @@ class HX711(object):
     MIN_VALUE = const(0x800000)
     READY_TIMEOUT_SEC = const(5)
     SLEEP_DELAY_USEC = const(80)
+    POLL_MS = const(10)
 
     def __init__(self, d_out: int, pd_sck: int, channel: int = CHANNEL_A_128):
         self.d_out_pin = Pin(d_out, Pin.IN)
         self.pd_sck_pin = Pin(pd_sck, Pin.OUT, value=0)
+        self._dout = self.d_out_pin.value
+        self._sck = self.pd_sck_pin.value
+        self._flag = ThreadSafeFlag() if ThreadSafeFlag else None
         self.channel = channel
 
     def __repr__(self):
@@ -54,9 +87,7 @@ class HX711(object):
         2 pulses for Channel B with gain 32
         1 pulse for Channel A with gain 128
         """
-        for i in range(self._channel):
-            self.pd_sck_pin.value(1)
-            self.pd_sck_pin.value(0)
+        _pulse(self._sck, self._channel)
 
     def _wait(self):
         """
@@ -97,9 +128,7 @@ class HX711(object):
         if not self.is_ready():
             self._wait()
 
-        for i in range(self.DATA_BITS):
-            self.pd_sck_pin.value(1)
-            self.pd_sck_pin.value(0)
+        _pulse(self._sck, self.DATA_BITS)
 
         self._set_channel()
 
@@ -108,7 +137,7 @@ class HX711(object):
         When output data is not ready for retrieval,
         digital output pin DOUT is high.
         """
-        return self.d_out_pin.value() == 0
+        return self._dout() == 0
 
     def power_off(self):
         """
@@ -137,14 +166,58 @@ class HX711(object):
         if not self.is_ready():
             self._wait()
 
-        raw_data = 0
-        for i in range(self.DATA_BITS):
-            self.pd_sck_pin.value(1)
-            self.pd_sck_pin.value(0)
-            raw_data = raw_data << 1 | self.d_out_pin.value()
+        raw_data = _shift_in(self._sck, self._dout, self.DATA_BITS)
         self._set_channel()
 
         if raw:
             return raw_data
         else:
             return self._convert_from_twos_complement(raw_data)
+
+    def _on_ready(self, pin):
+        self._flag.set()
+
+    async def _wait_async(self, timeout_ms):
+        """
+        Sleeps until DOUT goes low, woken by a falling edge IRQ on
+        the DOUT pin (or, before MicroPython 1.15, by polling every
+        POLL_MS), so other tasks run during the up to 100 ms the
+        HX711 takes per conversion.
+        """
+        t0 = ticks_ms()
+        if self._flag is None:
+            while not self.is_ready():
+                if ticks_diff(ticks_ms(), t0) > timeout_ms:
+                    raise DeviceIsNotReady()
+                await asyncio.sleep_ms(self.POLL_MS)
+            return
+        self.d_out_pin.irq(self._on_ready, Pin.IRQ_FALLING)
+        try:
+            while not self.is_ready():  # DOUT may have fallen before the IRQ was set
+                left = timeout_ms - ticks_diff(ticks_ms(), t0)
+                try:
+                    await asyncio.wait_for_ms(self._flag.wait(), max(left, 0))
+                except asyncio.TimeoutError:
+                    if not self.is_ready():
+                        raise DeviceIsNotReady()
+        finally:
+            self.d_out_pin.irq(None)  # the data bits toggle DOUT too
+
+    async def power_on_async(self):
+        """
+        Like power_on(), but awaits the first conversion after the
+        reset (about 400 ms at 10 samples/s) and discards it, which
+        also selects the channel again.
+        """
+        self._sck(0)
+        await self.read_async()
+
+    async def read_async(self, raw=False, timeout_ms=READY_TIMEOUT_SEC * 1000):
+        """
+        Like read(), but awaits the conversion instead of spinning
+        on DOUT.  Only the 25-27 clock pulses block, for well under
+        a millisecond.
+        """
+        if not self.is_ready():
+            await self._wait_async(timeout_ms)
+        return self.read(raw)
@@ -11,31 +11,71 @@
 # the code below uses asyncio which requires a recent (more recent than May 20, 2020) micropython firmware for the ESP32
 # firmware can be downloaded from here: https://micropython.org/download/esp32/
 
+import time
+BOOT_T0 = time.ticks_ms() # boot phase timings are reported in the 'online' message
 from mqtt_as import MQTTClient, config
-from config import wifi_led, blue_led, ph_topic_pub, orp_topic_pub, topic_sub, resp_pub, Sensor, Pump, Temp_sensor
+from config import wifi_led, blue_led, ph_topic_pub, orp_topic_pub, state_topic_pub, fc_topic_pub, temp_topic_pub, publish_mode, topic_sub, resp_pub, Sensor, Pump, Dosing, Tank
 import uasyncio as asyncio
-from machine import Pin, RTC, UART, reset
-from array import *
-import time
-import sys
-import network
+from machine import Pin, UART
+from rolling import RollingStats, SampleFilter, OutlierGate
+from ezo import EZO, EZOError
+from spool import Spool
+from commands import Router, CommandError, seconds, grams
+from pumps import PumpScheduler
+import json
+# dosing, the tank, temperature, RSSI and NTP are imported where they are first
+# used, so a controller that does not use them does not compile them at boot
 
 loop = asyncio.get_event_loop()
 outages = 0
-ph_vals=[] # list to hold ph values
-orp_vals=[] # list to hold ORP values
+# in addition to providing the latest pH and ORP values, the program will provide
+# a moving average value along with the rolling min, max, variance and EMA.
+# Averaging windows are defined in the config.txt file
+ph_stats=RollingStats(Sensor.ph_ma_window) # rolling statistics of pH values
+orp_stats=RollingStats(Sensor.orp_ma_window) # rolling statistics of ORP values
+# each report is the trimmed mean of ezo_samples readings, and a report far
+# from the moving average is held back as a spike unless it persists
+ph_filter=SampleFilter(Sensor.ezo_samples, Sensor.ph_min, Sensor.ph_max, Sensor.ezo_trim)
+orp_filter=SampleFilter(Sensor.ezo_samples, Sensor.orp_min, Sensor.orp_max, Sensor.ezo_trim)
+ph_gate=OutlierGate(ph_stats, Sensor.outlier_sigmas, Sensor.ph_outlier_floor, Sensor.outlier_max_rejects)
+orp_gate=OutlierGate(orp_stats, Sensor.outlier_sigmas, Sensor.orp_outlier_floor, Sensor.outlier_max_rejects)
 cal_finish=False
+# readings taken while WiFi or the broker is down are kept here and replayed,
+# oldest first, by forwarder() once the connection is back
+spool=Spool(Sensor.spool_size, Sensor.spool_file, Sensor.spool_file_max, Sensor.spool_drop)
+CHANNELS=('ph', 'orp') # spool channel numbers
+EPOCH_OFFSET=946684800 if time.gmtime(0)[0] == 2000 else 0 # MicroPython time() counts from 2000
+boot_ms={} # phase: ms, for the 'online' message
+clock_fix=0 # seconds the RTC jumped at the first NTP sync
+clock_synced=None # RTC time just before that sync; readings spooled earlier get clock_fix added
+clock_checked=False # True once an NTP sync has been tried, so the spool can be replayed
+rssi=None # last RSSI reading, published in the state payload
+fc_table=None # ORP-FC chart, for free chlorine from the moving averages
+pulsing=False # True while the blue LED is mid-pulse
 
 # pushing the right button on the ESP32 will exit the program back to REPL
 def exit_to_repl(pin):
+    import sys
     client.close()
     blue_led(True)
     sys.exit('Exiting to REPL')
 
+# Signal strength of the connected AP for the state payload.  Cheaper than the scan
+# below, but not every port supports it, so fall back to the last scanned value.
+def current_rssi():
+    global rssi
+    import network
+    try:
+        rssi = network.WLAN(network.STA_IF).status('rssi')
+    except (ValueError, OSError, TypeError):
+        pass
+    return rssi
+
 # RSSI is available if your WiFi is broadcasting an SSID.  Doesn't work if
 # the SSID is not broadcast.
 async def get_rssi():
     global rssi
+    import network
     s = network.WLAN()
     ssid = config['ssid'].encode('UTF8')
     try:
@@ -45,126 +85,151 @@ async def get_rssi():
     print('RSSI: {}'.format(rssi))
     loop.create_task(client.publish(resp_pub, 'RSSI: {}'.format(rssi), qos = 1))
 
-# Temperature is read from a DS18B20 Temperature sensor.  In principle, many sensors
-# can be connected if desired.
-async def get_temp():
+# pH and ORP are read through ezo.EZO, which awaits the module's own answer
+# instead of sleeping a fixed second.  A failed read raises an EZOError rather
+# than returning a made-up value, so nothing bogus reaches the moving averages.
+async def read_probe(probe):
     try:
-        t=Temp_sensor()
-        roms=t.scan()
-        t.convert_temp()
-        await asyncio.sleep(0.75)
-        for rom in roms:
-            temp=t.read_temp(rom)
-            print('rom: {}'.format(rom))
-            print('temp: {}'.format(temp))
-            loop.create_task(client.publish(resp_pub, 'temp: {}'.format(temp), qos = 1))
-    except:
-        loop.create_task(client.publish(resp_pub, 'temp sensor error', qos = 1))
-
-async def send_command(u, cmd):
-    command_to_send=cmd+'\r'
-    resp=u.write(command_to_send)
-    print('Received response: {}'.format(resp))
-    return resp
-
-# in addition to providing the latest pH and ORP values, the program will provide
-# a moving average value.  Averaging window is defined in the config.txt file
-def moving_average(a, v, w): # an existing list of values, a new value, and an averaging window
-    a.append(v) # add new value to the list
-    if len(a)>w:
-        a.pop(0) # if the new list is longer than the window, then pop the oldest item
-    avg=sum(a)/len(a) # average the new list
-    return(a, avg)
-
-async def read_response(u):
+        return await probe.read()
+    except EZOError as e:
+        print('{} read failed: {}'.format(probe, e))
+        loop.create_task(client.publish(resp_pub, '{} sensor error'.format(probe.name), qos = 1))
+        return None
+
+# The sampler's read: ezo_samples readings through filt, so one bad reading
+# out of a burst does not reach the report.  None if nothing usable was read.
+async def read_filtered(probe, filt):
+    filt.reset()
     try:
-        r=u.read().decode("utf-8")
-        print('response: {}'.format(r))
-    except:
-        print('{} timeout'.format(u))
-        r='8.888' + '\r' # in case of a timeout, send a default 8.888 pH value
-    return r
-
-
-async def read_ph(u):
-     await send_command(u, 'R')
-     await asyncio.sleep(1)
-     reading = await read_response(u)
-     ph=float(reading.split('\r')[0])
-     return ph
-
-async def read_orp(u):
-     await send_command(u, 'R')
-     await asyncio.sleep(1)
-     reading = await read_response(u)
-     orp=float(reading.split('\r')[0])
-     return orp
-
+        await probe.read_many(Sensor.ezo_samples, filt.add, Sensor.ezo_sample_mode == 'continuous')
+    except EZOError as e:
+        print('{} read failed: {}'.format(probe, e))
+        loop.create_task(client.publish(resp_pub, '{} sensor error'.format(probe.name), qos = 1))
+        return None
+    return filt.value()
 
 async def pulse():  # This demo pulses blue LED each time a subscribed msg arrives.
+    global pulsing
     blue_led(True)
     await asyncio.sleep(0.5)
     blue_led(False)
     await asyncio.sleep(0.5)
+    pulsing=False
     return True
 
-async def turn_on_pump(pump, on_time):
-    if pump == Pump.PH_PUMP:
-        print('turning on pump {}'.format(pump))
-        Pump.pump_1_pin.on()
-        asyncio.create_task(client.publish(resp_pub, 'ph:on', qos = 1))
-        w = await (asyncio.sleep(on_time))
-        print('turning off pump {}'.format(pump))
-        Pump.pump_1_pin.off()
-        asyncio.create_task(client.publish(resp_pub, 'ph:off', qos = 1))
-    elif pump == Pump.ORP_PUMP:
-        print('turning on pump {}'.format(pump))
-        Pump.pump_2_pin.on()
-        asyncio.create_task(client.publish(resp_pub, 'orp:on', qos = 1))
-        w = await (asyncio.sleep(on_time))
-        print('turning off pump {}'.format(pump))
-        Pump.pump_2_pin.off()
-        asyncio.create_task(client.publish(resp_pub, 'orp:off', qos = 1))
+async def status(void1, void2):
+    await get_rssi()
+    if thermometer: # the cached readings, so status does not wait for a conversion
+        temps = [t for t in thermometer.as_dict().values() if t is not None]
+        for t in temps:
+            await client.publish(resp_pub, 'temp: {}'.format(t), qos = 1)
+        if not temps:
+            await client.publish(resp_pub, 'temp sensor error', qos = 1)
+    counters = {p.name: p.as_dict() for p in pumps.values()}
+    await client.publish(resp_pub, 'pumps: {}'.format(json.dumps(counters)), qos = 1)
+    if Dosing.enabled:
+        state = {pumps[k].name: dosers[k].as_dict() for k in dosers}
+        await client.publish(resp_pub, 'dosing: {}'.format(json.dumps(state)), qos = 1)
+    if tank:
+        await client.publish(resp_pub, 'tank: {}'.format(json.dumps(tank.as_dict())), qos = 1)
+    return True
 
+# Pumps are switched by their PumpScheduler tasks, which report each edge here.
+# Edges during an outage are not queued up; 'status' gives the pumps' state.
+def pump_edge(name, state):
+    print('{} pump {}'.format(name, state))
+    if client.isconnected():
+        loop.create_task(client.publish(resp_pub, '{}:{}'.format(name, state), qos = 1))
+
+# An 'on' while the pump is already running extends the dose rather than
+# starting a second one.  If the daily budget cuts it short, say so.
+async def turn_on_pump(pump, on_time):
+    p = pumps[pump]
+    granted = p.request(on_time)
+    print('{} pump: {} s requested, running for {} s'.format(p.name, on_time, granted))
+    if granted < on_time:
+        await client.publish(resp_pub, '{}:limit:{}'.format(p.name, int(granted)), qos = 1)
     return True
 
 async def turn_off_pump(pump, nothing):
-    if pump==Pump.PH_PUMP:
-        print('turning off pump {}'.format(pump))
-        Pump.pump_1_pin.off()
-        await client.publish(resp_pub, 'ph:off', qos = 1)
-    elif pump == Pump.ORP_PUMP:
-        print('turning off pump {}'.format(pump))
-        Pump.pump_1_pin.off()
-        await client.publish(resp_pub, 'orp:off', qos = 1)
+    p = pumps[pump]
+    if not p.stop(): # already off, so there is no edge to report
+        await client.publish(resp_pub, '{}:off'.format(p.name), qos = 1)
     return True
 
-async def calibrate(sensor, interval, timeout=300):
-    global cal_finish
-    global ph_uart
-    global orp_uart
+# Tank level after each weighing, e.g. {"grams": 18250, "g_per_pump_s": 0.52, ...}
+def tank_report(t):
+    if client.isconnected():
+        loop.create_task(client.publish(Tank.topic_pub, json.dumps(t.as_dict()), qos = 1))
+
+# Water temperature after each conversion cycle, plus every probe by ROM when there are several
+def temp_report(t):
+    if client.isconnected() and t.value is not None:
+        loop.create_task(client.publish(temp_topic_pub, '{}'.format(t.value), qos = 1))
+        if len(t.temps) > 1:
+            loop.create_task(client.publish(temp_topic_pub + b'/probes', json.dumps(t.as_dict()), qos = 1))
+
+async def temp_scan(t, nothing):
+    t.rescan()
+    await client.publish(resp_pub, 'temp:scan:done', qos = 1)
+    return True
+
+# tank:tare with the tank off the scale, then tank:cal:<grams> with a known weight on it
+async def tank_tare(t, nothing):
+    try:
+        await t.tare()
+    except (HX711Exception, OSError) as e:
+        print('tank tare failed: {}'.format(e))
+        await client.publish(resp_pub, 'tank sensor error', qos = 1)
+        return False
+    await client.publish(resp_pub, 'tank:tare:done', qos = 1)
+    return True
+
+async def tank_cal(t, weight):
+    try:
+        scale = await t.calibrate(weight)
+    except (HX711Exception, OSError, ValueError) as e:
+        print('tank calibration failed: {}'.format(e))
+        await client.publish(resp_pub, 'tank:cal:failed', qos = 1)
+        return False
+    await client.publish(resp_pub, 'tank:cal:{:.2f}'.format(scale), qos = 1)
+    return True
 
+async def calibrate(sensor, interval, timeout=300):
     cal_start=time.time()
     print('cal_start: {}'.format(cal_start))
+    doser=dosers.get(sensor)
+    if doser: # the probe is in calibration solution, so its readings mean nothing
+        doser.pause()
+    try:
+        return await _calibrate(sensor, interval, cal_start, timeout)
+    finally:
+        if doser:
+            doser.resume()
+
+async def _calibrate(sensor, interval, cal_start, timeout):
+    global cal_finish
     await client.publish(resp_pub, 'cal:{}:start'.format(sensor), qos = 1)
     while True:
         if sensor==1:
-            ph=await read_ph(ph_uart)
+            ph=await read_probe(ph_probe)
             print("Ph: {}".format(ph))
-            await client.publish(ph_topic_pub, '{}'.format(ph), qos = 1)
+            if ph is not None:
+                await client.publish(ph_topic_pub, '{}'.format(ph), qos = 1)
         elif sensor==2:
-            orp=await read_orp(orp_uart)
+            orp=await read_probe(orp_probe)
             print("ORP: {}".format(orp))
-            await client.publish(orp_topic_pub, '{}'.format(orp), qos = 1)
+            if orp is not None:
+                await client.publish(orp_topic_pub, '{}'.format(orp), qos = 1)
         await asyncio.sleep(interval)
         print('time now: {}'.format(time.time()))
         if cal_finish:
             if sensor == 1:
                 print('issuing Ph cal mid command')
-                await send_command(ph_uart,'Cal,mid,7.00')
+                await ph_probe.command('Cal,mid,7.00')
             elif sensor == 2:
                 print('issuing ORP cal command')
-                await send_command(ph_uart,'cal,225')
+                await orp_probe.command('cal,225')
             print('Calibration Finished')
             await client.publish(resp_pub, 'cal:{}:end'.format(sensor), qos = 1)
             cal_finish=False
@@ -179,53 +244,18 @@ async def check_cal_finish(void1,void2):
     cal_finish=True
     return True
 
-
-async def unknown_command():
-    print('Unknown command received, ignoring')
-    return False
-
 # callback to process incoming commands received over MQTT
+# message format: ph:on:30.  The router parses and queues it; router.run() executes it.
 def sub_cb(topic, msg, retained):
-    global commands
-    print('in sub_cb')
-    #message format: ph:on:30
-    message=msg.decode().lower()
-    loop.create_task(pulse())
-    print('topic: {}, msg: {}'.format(topic, message))
-    if message == 'status':
-        loop.create_task(get_rssi())
-        loop.create_task(pulse())
+    global pulsing
+    if not pulsing:
+        pulsing=True
         loop.create_task(pulse())
-        loop.create_task(get_temp())
-        loop.create_task(pulse())
-        loop.create_task(pulse())
-
-    else:
-        try:
-            print('trying')
-            msg_split=message.split(':')
-            cmd=commands.get(msg_split[1], unknown_command)
-        except:
-            cmd='unknown'
-            print('Unknown command received, ignoring')
-            loop.create_task(client.publish(resp_pub, 'unknown command', qos = 1))
-        print('received command: {}'.format(cmd))
-
-        if msg_split[0]=='ph': # MQTT command string starts with ph:
-            try:
-                command_arg=msg_split[2]
-            except:
-                command_arg='0'
-            print('About to execute ph command')
-            loop.create_task(cmd(Pump.PH_PUMP,int(command_arg)))
-
-        if msg_split[0]=='orp': # MQTT command string starts with orp:
-            try:
-                command_arg=msg_split[2]
-            except:
-                command_arg='0'
-            print('About to execute orp command')
-            loop.create_task(cmd(Pump.ORP_PUMP,int(command_arg)))
+    try:
+        router.submit(msg) # msg is a view into the MQTT receive buffer
+    except CommandError as e:
+        print('{}: {}'.format(e, bytes(msg)))
+        loop.create_task(client.publish(resp_pub, str(e), qos = 1))
 
 async def wifi_han(state):
     global outages
@@ -238,55 +268,198 @@ async def wifi_han(state):
     await asyncio.sleep(1)
 
 async def conn_han(client):
+    global clock_fix, clock_synced, clock_checked
+    try: # spooled readings are timestamped, so keep the RTC right
+        import ntptime
+        before = time.time()
+        ntptime.settime()
+        if clock_synced is None: # readings taken since boot were stamped by the unset RTC
+            clock_fix = round(time.time() - before)
+            clock_synced = before
+    except Exception as e:
+        print('NTP sync failed: {}'.format(e))
+    clock_checked = True
     await client.subscribe(topic_sub, 1)
 
-async def main(client):
-    global ph_vals
-    global orp_vals
-    global ph_uart
-    global orp_uart
-    try:
-        await client.connect()
-    except OSError:
-        print('Connection failed.')
-        await asyncio.sleep(5)
-        reset()
+# Samples are handed from the sampler tasks to the publisher through a bounded
+# queue.  A slow probe or a slow PUBACK can then never hold up the other probe.
+# If the publisher falls behind, the oldest sample is dropped.
+class SampleQueue:
+    def __init__(self, size):
+        self._items = []
+        self._size = size
+        self._evt = asyncio.Event()
+        self.dropped = 0
+
+    def put(self, item):  # never blocks, so samplers keep their own schedule
+        if len(self._items) >= self._size:
+            self._items.pop(0)
+            self.dropped += 1
+        self._items.append(item)
+        self._evt.set()
+
+    async def get(self):
+        while not self._items:
+            self._evt.clear()
+            await self._evt.wait()
+        return self._items.pop(0)
+
+# One sampler task runs per probe.  Each reads its own UART every report_interval
+# and queues (key, topic, value, stats) for the publisher.  Failed reads and
+# spikes rejected by the gate are skipped.
+# Sampling carries on during outages; those readings go to the spool instead.
+async def sampler(probe, topic, stats, q, filt, gate):
+    key = probe.name.lower()
+    while True:
+        t = time.ticks_ms()
+        value = await read_filtered(probe, filt)
+        print('{}: {}'.format(probe.name, value))
+        if value is not None and not gate.accept(value):
+            print('{}: {} rejected as an outlier'.format(probe.name, value))
+        elif value is not None:
+            if 'first_read' not in boot_ms:
+                boot_ms['first_read'] = time.ticks_diff(time.ticks_ms(), BOOT_T0)
+            stats.add(value)
+            if client.isconnected():
+                q.put((key, topic, value, stats))
+            else:
+                spool.append(int(time.time()), CHANNELS.index(key), value)
+        elapsed = time.ticks_diff(time.ticks_ms(), t) / 1000
+        await asyncio.sleep(max(0, Sensor.report_interval - elapsed))
+
+# Free chlorine (ppm) from the pH and ORP moving averages, by the ORP-FC chart.
+# None without the chart, before both probes have reported or off the chart.
+def current_fc():
+    if fc_table is None or not ph_stats.count or not orp_stats.count:
+        return None
+    fc = fc_table.lookup(ph_stats.mean, orp_stats.mean)
+    return None if fc is None else fc / 1000
+
+# Everything sampled in one report cycle, coalesced into one payload for the
+# state topic when publish_mode is 'state' or 'both'.
+def state_payload(state):
+    state['temp'] = thermometer.value if thermometer else None
+    state['fc'] = current_fc()
+    state['rssi'] = current_rssi()
+    state['ph_pump'] = pumps[Pump.PH_PUMP].pin.value()
+    state['orp_pump'] = pumps[Pump.ORP_PUMP].pin.value()
+    return json.dumps(state)
+
+# Readings for a new cycle; a probe that misses it is reported as None rather
+# than with the value it sent last cycle.
+def empty_state():
+    return {k: None for c in CHANNELS for k in (c, c + '_avg')}
+
+# Drains the sample queue.  If WiFi is down the publish will pause for the
+# duration but the samplers keep running.  publish_mode selects the per-value
+# topics ('topics'), one state message per cycle ('state') or both.
+async def publisher(q):
     n = 0
+    state = empty_state()
+    seen = set() # probes sampled since the last state publish
+    while True:
+        key, topic, value, stats = await q.get()
+        if not client.isconnected(): # went down while this was queued
+            spool.append(int(time.time()), CHANNELS.index(key), value)
+            continue
+        print('publish', n)
+        if publish_mode != 'state': # sent back to back; PUBACKs are awaited together
+            await asyncio.gather(
+                client.publish(topic, '{}'.format(value), qos = 1),
+                client.publish(topic + b'/moving_average', '{}'.format(stats.mean), qos = 1),
+                client.publish(topic + b'/stats', json.dumps(stats.as_dict()), qos = 1))
+            fc = current_fc()
+            if key == 'orp' and fc is not None: # once per cycle, with the ORP average it follows
+                await client.publish(fc_topic_pub, '{:.2f}'.format(fc), qos = 1)
+        if publish_mode != 'topics':
+            if key in seen: # a probe came round again before the other one reported
+                await client.publish(state_topic_pub, state_payload(state), qos = 1)
+                state = empty_state()
+                seen.clear()
+            state[key] = value
+            state[key + '_avg'] = round(stats.mean, 3)
+            seen.add(key)
+            if len(seen) == 2:
+                await client.publish(state_topic_pub, state_payload(state), qos = 1)
+                state = empty_state()
+                seen.clear()
+        n += 1
+
+# Replays spooled readings once the broker is reachable again, oldest first, in
+# batches on <topic>/history as JSON [[unix time, value], ...].
+async def forwarder():
+    topics = (ph_topic_pub, orp_topic_pub)
+    while True:
+        await asyncio.sleep(1)
+        while len(spool) and client.isconnected() and clock_checked:
+            batch = spool.peek(Sensor.spool_batch)
+            rows = ([], [])
+            for ts, ch, value in batch:
+                if clock_synced is not None and ts <= clock_synced:
+                    ts += clock_fix
+                rows[ch].append([ts + EPOCH_OFFSET, round(value, 3)])
+            for ch in range(len(topics)):
+                if rows[ch]:
+                    await client.publish(topics[ch] + b'/history', json.dumps(rows[ch]), qos = 1)
+            spool.commit(len(batch))
+            print('replayed {} spooled readings, {} left'.format(len(batch), len(spool)))
+
+# The first connection is retried here, with a growing pause, rather than by
+# rebooting; mqtt_as looks after the connection once it has been made.
+async def connect(client):
+    tries = 0
+    pause = 5
+    while True:
+        tries += 1
+        try:
+            await client.connect()
+            return tries
+        except OSError:
+            print('Connection failed, retrying in {} s.'.format(pause))
+        await asyncio.sleep(pause)
+        pause = min(pause * 2, 300)
+
+# Staged start: the probes are opened and sampled straight away, and readings
+# are spooled until WiFi and the broker are up, when they are replayed.
+async def main(client):
+    global ph_probe
+    global orp_probe
+    boot_ms['import'] = time.ticks_diff(time.ticks_ms(), BOOT_T0)
+    loop.create_task(router.run())
+    for p in pumps.values():
+        loop.create_task(p.run())
+    for doser in dosers.values(): # needs only the samplers and pumps, so runs offline too
+        loop.create_task(doser.run())
+    if tank:
+        loop.create_task(tank.run())
+    if thermometer:
+        loop.create_task(thermometer.run())
+    t = time.ticks_ms()
     try:
         ph_uart=UART(Sensor.ph_uart_port, tx=Sensor.ph_tx, rx=Sensor.ph_rx)
         ph_uart.init(9600, bits=8, parity=None, stop=1)
+        ph_probe=EZO(ph_uart, 'Ph', Sensor.ezo_read_timeout_ms)
     except OSError:
         print('Ph UART failed.')
         return
     try:
         orp_uart=UART(Sensor.orp_uart_port, tx=Sensor.orp_tx, rx=Sensor.orp_rx)
         orp_uart.init(9600, bits=8, parity=None, stop=1)
+        orp_probe=EZO(orp_uart, 'ORP', Sensor.ezo_read_timeout_ms)
     except OSError:
         print('orp UART failed.')
         return
-    await client.publish(resp_pub, 'online', qos = 1)
-    await asyncio.sleep(5)
-    while True:
-        ma=()
-        print('publish', n)
-        # If WiFi is down the following will pause for the duration.
-        ph=await read_ph(ph_uart)
-        print("Ph: {}".format(ph))
-        await client.publish(ph_topic_pub, '{}'.format(ph), qos = 1)
-        print('ph_vals: {}'.format(ph_vals))
-        print('ph: {}'.format(ph))
-        print('ma_window: {}'.format(Sensor.ph_ma_window))
-        ma=moving_average(ph_vals, float(ph), Sensor.ph_ma_window)
-        await client.publish(ph_topic_pub + '/moving_average', '{}'.format(ma[1]), qos = 1)
-        ph_vals=ma[0]
-        orp=await read_orp(orp_uart)
-        print("ORP: {}".format(orp))
-        await client.publish(orp_topic_pub, '{}'.format(orp), qos = 1)
-        ma=moving_average(orp_vals, float(orp), Sensor.orp_ma_window)
-        await client.publish(orp_topic_pub + '/moving_average', '{}'.format(ma[1]), qos = 1)
-        orp_vals=ma[0]
-        await asyncio.sleep(Sensor.report_interval)
-        n += 1
+    q = SampleQueue(Sensor.sample_queue_size)
+    loop.create_task(sampler(ph_probe, ph_topic_pub, ph_stats, q, ph_filter, ph_gate))
+    loop.create_task(sampler(orp_probe, orp_topic_pub, orp_stats, q, orp_filter, orp_gate))
+    loop.create_task(forwarder())
+    boot_ms['uarts'] = time.ticks_diff(time.ticks_ms(), t)
+    t = time.ticks_ms()
+    tries = await connect(client)
+    boot_ms['connect'] = time.ticks_diff(time.ticks_ms(), t)
+    boot_ms['online'] = time.ticks_diff(time.ticks_ms(), BOOT_T0)
+    await client.publish(resp_pub, 'online: {}'.format(json.dumps({'boot_ms': boot_ms, 'tries': tries})), qos = 1)
+    await publisher(q)
 
 # Define configuration
 config['subs_cb'] = sub_cb # defines the coroutine to run if a message is received
@@ -295,19 +468,75 @@ config['will'] = (topic_sub, 'offline', False, 0)  # last will
 config['connect_coro'] = conn_han # handler for successful connection to MQTT broker
 print('ph_pump: {}'.format(Pump.PH_PUMP))
 print('orp_pump: {}'.format(Pump.ORP_PUMP))
-# the below dictionary defines the coroutines to be run in the event the command defined
-# by the dictionary key is received.
-commands = {
-    'on': turn_on_pump,
-    'off': turn_off_pump,
-    'cal': calibrate,
-    'done': check_cal_finish
+# one scheduler per pump, keyed by the pump numbers commands and calibrate use
+pumps = {
+    Pump.PH_PUMP: PumpScheduler(Pin(Pump.pump_1_pin, Pin.OUT), 'ph', Pump.ph_daily_max, Pump.min_off, pump_edge),
+    Pump.ORP_PUMP: PumpScheduler(Pin(Pump.pump_2_pin, Pin.OUT), 'orp', Pump.orp_daily_max, Pump.min_off, pump_edge)
 }
 
+# closed loop dosing: acid lowers pH, bleach raises ORP
+dosers = {}
+if Dosing.enabled:
+    from dosing import PID, Doser, RAISES, LOWERS
+    dosers[Pump.PH_PUMP] = Doser(PID(Dosing.ph_setpoint, Dosing.ph_kp, Dosing.ph_ki, Dosing.ph_kd,
+        Dosing.ph_deadband, Dosing.ph_max_pulse, direction=LOWERS),
+        ph_stats, pumps[Pump.PH_PUMP], Dosing.interval, Sensor.ph_ma_window)
+    dosers[Pump.ORP_PUMP] = Doser(PID(Dosing.orp_setpoint, Dosing.orp_kp, Dosing.orp_ki, Dosing.orp_kd,
+        Dosing.orp_deadband, Dosing.orp_max_pulse, direction=RAISES),
+        orp_stats, pumps[Pump.ORP_PUMP], Dosing.interval, Sensor.orp_ma_window)
+
+# free chlorine is estimated on the controller too, so it is known with Home Assistant down
+if Sensor.fc_table:
+    from chlorine import FcTable
+    try:
+        fc_table = FcTable(Sensor.fc_table)
+    except (OSError, ValueError) as e:
+        print('FC table {} not loaded: {}'.format(Sensor.fc_table, e))
+
+# DS18B20 probes on ds_pin, converted every temp_interval seconds
+thermometer = None
+if Sensor.temp_interval:
+    from temperature import Thermometer
+    thermometer = Thermometer(Sensor.ds_pin, Sensor.temp_interval, temp_report)
+
+# chemical tank on the load cell, weighed every Tank.interval seconds
+tank = None
+if Tank.enabled:
+    from hx711 import HX711Exception
+    from scales import Scales
+    from tank import TankMonitor
+    try:
+        tank = TankMonitor(Scales(Sensor.load_cell_d_out_pin, Sensor.load_cell_pd_sck_pin),
+            pumps[Pump.PH_PUMP if Tank.pump == 'ph' else Pump.ORP_PUMP], Tank.interval,
+            Tank.reads, Tank.window, Tank.refill_g, Tank.file, tank_report)
+    except HX711Exception:
+        print('load cell not found')
+
+# the commands accepted on topic_sub and the coroutines they run.  Each target runs
+# one command at a time; off and done go straight through so they can interrupt.
+router = Router(Sensor.command_queue_size)
+router.target('ph', Pump.PH_PUMP)
+router.target('orp', Pump.ORP_PUMP)
+router.target('status')
+for t in ('ph', 'orp'):
+    router.route(t, 'on', turn_on_pump, seconds)
+    router.route(t, 'off', turn_off_pump, exclusive=False)
+    router.route(t, 'cal', calibrate, seconds)
+    router.route(t, 'done', check_cal_finish, exclusive=False)
+router.route('status', '', status)
+if thermometer:
+    router.target('temp', thermometer)
+    router.route('temp', 'scan', temp_scan)
+if tank:
+    router.target('tank', tank)
+    router.route('tank', 'tare', tank_tare)
+    router.route('tank', 'cal', tank_cal, grams)
+
 # Set up client. Enable optional debug statements.
 MQTTClient.DEBUG = True
 client = MQTTClient(config)
-Sensor.repl_button.irq(trigger=Pin.IRQ_FALLING, handler=exit_to_repl)
+repl_button = Pin(0, Pin.IN, Pin.PULL_UP) # exits the program
+repl_button.irq(trigger=Pin.IRQ_FALLING, handler=exit_to_repl)
 
 try:
     loop.run_until_complete(main(client))
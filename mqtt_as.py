@@ -14,7 +14,7 @@ from ubinascii import hexlify
 import uasyncio as asyncio
 
 gc.collect()
-from utime import ticks_ms, ticks_diff
+from utime import ticks_ms, ticks_diff, ticks_add
 from uerrno import EINPROGRESS, ETIMEDOUT
 
 gc.collect()
@@ -30,6 +30,7 @@ VERSION = (0, 6, 0)
 # Default short delay for good SynCom throughput (avoid sleep(0) with SynCom).
 _DEFAULT_MS = const(20)
 _SOCKET_POLL_DELAY = const(5)  # 100ms added greatly to publish latency
+_READ_IDLE_MS = const(1000)  # Longest the idle reader sleeps before rechecking the link
 
 # Legitimate errors while waiting on a socket. See uasyncio __init__.py open_connection().
 if platform == 'esp32' or platform == 'esp32_LoBo':
@@ -63,12 +64,14 @@ config = {
     'clean_init':    True,
     'clean':         True,
     'max_repubs':    4,
+    'max_inflight':  8,
     'will':          None,
     'subs_cb':       lambda *_: None,
     'wifi_coro':     eliza,
     'connect_coro':  eliza,
     'ssid':          None,
     'wifi_pw':       None,
+    'rx_buf_size':   256,
 }
 
 
@@ -76,6 +79,13 @@ class MQTTException(Exception):
     pass
 
 
+class _InFlight:  # a pid awaiting its ACK
+    def __init__(self):
+        self.event = asyncio.Event()  # set on ACK or expiry
+        self.acked = False
+        self.deadline = 0  # ticks_ms by which the ACK is due
+
+
 def pid_gen():
     pid = 0
     while True:
@@ -83,6 +93,10 @@ def pid_gen():
         yield pid
 
 
+def _b(s):  # topics and payloads may be given as str or bytes
+    return s.encode() if isinstance(s, str) else s
+
+
 def qos_check(qos):
     if not (qos == 0 or qos == 1):
         raise ValueError('Only qos 0 and 1 are supported.')
@@ -128,12 +142,30 @@ class MQTT_base:
         if self.server is None:
             raise ValueError('no server specified.')
         self._sock = None
+        self._stream = None  # uasyncio stream on _sock: sleeps until it is readable
         self._sta_if = network.WLAN(network.STA_IF)
         self._sta_if.active(True)
         self._sta_if.config(dhcp_hostname=config['hostname'])
 
+        # Receive buffer. Incoming packets are read into it with readinto() and
+        # handed on as memoryview slices, so receiving costs no per-packet copies.
+        # It grows (once) if a packet larger than the buffer arrives. Only the
+        # reader task (or _connect, before it starts) uses it.
+        self._rxbuf = bytearray(config['rx_buf_size'])
+        self._rxmv = memoryview(self._rxbuf)
+        self._ackpkt = bytearray(b"\x40\x02\0\0")  # PUBACK sent for qos 1 messages
+        # Transmit buffer. Outgoing packets are assembled into it and sent with a
+        # single write. Only used with self.lock held (or before tasks start).
+        self._txbuf = bytearray(config['rx_buf_size'])
+        self._txmv = memoryview(self._txbuf)
+
         self.newpid = pid_gen()
-        self.rcv_pids = set()  # PUBACK and SUBACK pids awaiting ACK response
+        # In-flight window: PUBLISH and SUBSCRIBE pids awaiting PUBACK/SUBACK.
+        # Up to max_inflight qos 1 messages may be unacknowledged at once; each
+        # publisher sleeps on its own entry's Event until the ACK or its deadline.
+        self._inflight = {}  # pid: _InFlight
+        self._max_inflight = config['max_inflight']
+        self._slot_free = asyncio.Event()  # set when an entry leaves the window
         self.last_rx = ticks_ms()  # Time of last communication from broker
         self.lock = asyncio.Lock()
 
@@ -153,28 +185,70 @@ class MQTT_base:
     def _timeout(self, t):
         return ticks_diff(ticks_ms(), t) > self._response_time
 
+    # Read exactly n bytes into the receive buffer. Returns a memoryview of them
+    # which is only valid until the next read. While the broker socket has
+    # nothing buffered the task sleeps on its stream until data arrives; other
+    # sockets (wan_ok) are polled and read into a buffer of their own.
     async def _as_read(self, n, sock=None):  # OSError caught by superclass
         if sock is None:
             sock = self._sock
-        data = b''
+            stream = self._stream
+            if n > len(self._rxbuf):
+                self._rxbuf = bytearray(n)
+                self._rxmv = memoryview(self._rxbuf)
+            mv = self._rxmv
+        else:
+            stream = None
+            mv = memoryview(bytearray(n))
+        got = 0
         t = ticks_ms()
-        while len(data) < n:
+        while got < n:
             if self._timeout(t) or not self.isconnected():
                 raise OSError(-1)
             try:
-                msg = sock.read(n - len(data))
+                k = sock.readinto(mv[got:n])
             except OSError as e:  # ESP32 issues weird 119 errors here
-                msg = None
+                k = None
                 if e.args[0] not in BUSY_ERRORS:
                     raise
-            if msg == b'':  # Connection closed by host
+            if k == 0:  # Connection closed by host
                 raise OSError(-1)
-            if msg is not None:  # data received
-                data = b''.join((data, msg))
-                t = ticks_ms()
-                self.last_rx = ticks_ms()
-            await asyncio.sleep_ms(_SOCKET_POLL_DELAY)
-        return data
+            if k is None:  # nothing yet
+                if stream is None:
+                    await asyncio.sleep_ms(_SOCKET_POLL_DELAY)
+                    continue
+                try:
+                    k = await self._stream_readinto(mv[got:n], self._response_time)
+                except asyncio.TimeoutError:
+                    raise OSError(-1)
+                if k is None:  # woken without data
+                    continue
+                if k == 0:
+                    raise OSError(-1)
+            got += k  # data received
+            t = ticks_ms()
+            self.last_rx = t
+        return mv[:n]
+
+    # Sleep until the broker socket is readable, then read into buf. Returns the
+    # number of bytes read, or None if woken without data. Firmware whose
+    # uasyncio Stream has no readinto() reads a bytes object and copies it in.
+    async def _stream_readinto(self, buf, timeout):
+        stream = self._stream
+        try:
+            if hasattr(stream, 'readinto'):
+                return await asyncio.wait_for_ms(stream.readinto(buf), timeout)
+            data = await asyncio.wait_for_ms(stream.read(len(buf)), timeout)
+        except asyncio.TimeoutError:  # an OSError under CPython, for the simulator
+            raise
+        except OSError as e:
+            if e.args[0] not in BUSY_ERRORS:
+                raise
+            return None
+        if data is None:
+            return None
+        buf[:len(data)] = data
+        return len(data)
 
     async def _as_write(self, bytes_wr, length=0, sock=None):
         if sock is None:
@@ -194,18 +268,43 @@ class MQTT_base:
             if n:
                 t = ticks_ms()
                 bytes_wr = bytes_wr[n:]
-            await asyncio.sleep_ms(_SOCKET_POLL_DELAY)
+            if bytes_wr:  # Socket buffer full: wait for it to drain
+                await asyncio.sleep_ms(_SOCKET_POLL_DELAY)
+
+    # Packet assembly. _txbuf_for(size) returns the transmit buffer grown to at least
+    # size bytes; the _put_* helpers write into it at offset i and return the
+    # offset after what they wrote.
+    def _txbuf_for(self, size):
+        if size > len(self._txbuf):
+            self._txbuf = bytearray(size)
+            self._txmv = memoryview(self._txbuf)
+        return self._txbuf
+
+    @staticmethod
+    def _put_len(buf, i, sz):  # MQTT variable length encoding
+        while sz > 0x7f:
+            buf[i] = (sz & 0x7f) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        return i + 1
 
-    async def _send_str(self, s):
-        await self._as_write(struct.pack("!H", len(s)))
-        await self._as_write(s)
+    @staticmethod
+    def _put_bytes(buf, i, s):
+        n = len(s)
+        buf[i:i + n] = s
+        return i + n
+
+    @staticmethod
+    def _put_str(buf, i, s):
+        struct.pack_into("!H", buf, i, len(s))
+        return MQTT_base._put_bytes(buf, i + 2, s)
 
     async def _recv_len(self):
         n = 0
         sh = 0
         while 1:
-            res = await self._as_read(1)
-            b = res[0]
+            b = (await self._as_read(1))[0]
             n |= (b & 0x7f) << sh
             if not b & 0x80:
                 return n
@@ -224,37 +323,33 @@ class MQTT_base:
         if self._ssl:
             import ussl
             self._sock = ussl.wrap_socket(self._sock, **self._ssl_params)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\0\0\0")  # Protocol 3.1.1
-
-        sz = 10 + 2 + len(self._client_id)
-        msg[6] = clean << 1
+        self._stream = asyncio.StreamReader(self._sock)
+        client_id = _b(self._client_id)
+        sz = 10 + 2 + len(client_id)
+        flags = clean << 1
         if self._user:
-            sz += 2 + len(self._user) + 2 + len(self._pswd)
-            msg[6] |= 0xC0
-        if self._keepalive:
-            msg[7] |= self._keepalive >> 8
-            msg[8] |= self._keepalive & 0x00FF
+            user, pswd = _b(self._user), _b(self._pswd)
+            sz += 2 + len(user) + 2 + len(pswd)
+            flags |= 0xC0
         if self._lw_topic:
-            sz += 2 + len(self._lw_topic) + 2 + len(self._lw_msg)
-            msg[6] |= 0x4 | (self._lw_qos & 0x1) << 3 | (self._lw_qos & 0x2) << 3
-            msg[6] |= self._lw_retain << 5
-
-        i = 1
-        while sz > 0x7f:
-            premsg[i] = (sz & 0x7f) | 0x80
-            sz >>= 7
-            i += 1
-        premsg[i] = sz
-        await self._as_write(premsg, i + 2)
-        await self._as_write(msg)
-        await self._send_str(self._client_id)
+            lw_topic, lw_msg = _b(self._lw_topic), _b(self._lw_msg)
+            sz += 2 + len(lw_topic) + 2 + len(lw_msg)
+            flags |= 0x4 | (self._lw_qos & 0x1) << 3 | (self._lw_qos & 0x2) << 3
+            flags |= self._lw_retain << 5
+        buf = self._txbuf_for(sz + 5)
+        buf[0] = 0x10
+        i = self._put_len(buf, 1, sz)
+        i = self._put_bytes(buf, i, b"\0\x04MQTT\x04")  # Protocol 3.1.1
+        buf[i] = flags
+        struct.pack_into("!H", buf, i + 1, self._keepalive)
+        i = self._put_str(buf, i + 3, client_id)
         if self._lw_topic:
-            await self._send_str(self._lw_topic)
-            await self._send_str(self._lw_msg)
+            i = self._put_str(buf, i, lw_topic)
+            i = self._put_str(buf, i, lw_msg)
         if self._user:
-            await self._send_str(self._user)
-            await self._send_str(self._pswd)
+            i = self._put_str(buf, i, user)
+            i = self._put_str(buf, i, pswd)
+        await self._as_write(self._txmv, i)
         # Await CONNACK
         # read causes ECONNABORTED if broker is out; triggers a reconnect.
         resp = await self._as_read(4)
@@ -318,130 +413,170 @@ class MQTT_base:
         if self._sock is not None:
             self._sock.close()
 
-    async def _await_pid(self, pid):
-        t = ticks_ms()
-        while pid in self.rcv_pids:  # local copy
-            if self._timeout(t) or not self.isconnected():
-                break  # Must repub or bail out
-            await asyncio.sleep_ms(100)
-        else:
-            return True  # PID received. All done.
-        return False
+    # Wait for room in the in-flight window, then claim a pid not already in it.
+    async def _reserve(self):
+        while len(self._inflight) >= self._max_inflight:
+            self._slot_free.clear()
+            await self._slot_free.wait()
+        pid = next(self.newpid)
+        while pid in self._inflight:
+            pid = next(self.newpid)
+        self._inflight[pid] = _InFlight()
+        return pid
+
+    # Remove pid from the window and wake its waiter. Returns False if the pid
+    # was not in flight (e.g. a late ACK for an expired message).
+    def _release(self, pid, acked):
+        entry = self._inflight.pop(pid, None)
+        if entry is None:
+            return False
+        entry.acked = acked
+        entry.event.set()
+        self._slot_free.set()
+        return True
+
+    def _expire_all(self):  # Connection lost: fail everything in flight
+        for pid in list(self._inflight):
+            self._release(pid, False)
+
+    # Wait for the entry's ACK until the deadline of its latest transmission.
+    # True if it was acknowledged.
+    async def _await_ack(self, entry):
+        entry.deadline = ticks_add(ticks_ms(), self._response_time)
+        wait = self._response_time
+        while not entry.event.is_set() and wait > 0:
+            try:
+                await asyncio.wait_for_ms(entry.event.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            wait = ticks_diff(entry.deadline, ticks_ms())
+        return entry.acked
 
-    # qos == 1: coro blocks until wait_msg gets correct PID.
+    # qos == 1: coro blocks until wait_msg gets correct PID. Other publishers
+    # can send while it waits, up to max_inflight unacknowledged messages.
     # If WiFi fails completely subclass re-publishes with new PID.
     async def publish(self, topic, msg, retain, qos):
-        pid = next(self.newpid)
-        if qos:
-            self.rcv_pids.add(pid)
-        async with self.lock:
-            await self._publish(topic, msg, retain, qos, 0, pid)
         if qos == 0:
+            async with self.lock:
+                await self._publish(topic, msg, retain, qos, 0, 0)
             return
 
-        count = 0
-        while 1:  # Await PUBACK, republish on timeout
-            if await self._await_pid(pid):
-                return
-            # No match
-            if count >= self._max_repubs or not self.isconnected():
-                raise OSError(-1)  # Subclass to re-publish with new PID
-            async with self.lock:
-                await self._publish(topic, msg, retain, qos, dup=1, pid=pid)  # Add pid
-            count += 1
-            self.REPUB_COUNT += 1
+        pid = await self._reserve()
+        entry = self._inflight[pid]
+        try:
+            dup = 0
+            count = 0
+            while 1:  # Await PUBACK, republish on timeout
+                async with self.lock:
+                    await self._publish(topic, msg, retain, qos, dup, pid)
+                if await self._await_ack(entry):
+                    return
+                # No match
+                if count >= self._max_repubs or not self.isconnected() or entry.event.is_set():
+                    raise OSError(-1)  # Subclass to re-publish with new PID
+                dup = 1
+                count += 1
+                self.REPUB_COUNT += 1
+        finally:
+            if self._inflight.get(pid) is entry:
+                self._release(pid, False)
 
     async def _publish(self, topic, msg, retain, qos, dup, pid):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain | dup << 3
+        topic, msg = _b(topic), _b(msg)
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
         if sz >= 2097152:
             raise MQTTException('Strings too long.')
-        i = 1
-        while sz > 0x7f:
-            pkt[i] = (sz & 0x7f) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        await self._as_write(pkt, i + 1)
-        await self._send_str(topic)
+        buf = self._txbuf_for(sz + 5)
+        buf[0] = 0x30 | qos << 1 | retain | dup << 3
+        i = self._put_len(buf, 1, sz)
+        i = self._put_str(buf, i, topic)
         if qos > 0:
-            struct.pack_into("!H", pkt, 0, pid)
-            await self._as_write(pkt, 2)
-        await self._as_write(msg)
+            struct.pack_into("!H", buf, i, pid)
+            i += 2
+        i = self._put_bytes(buf, i, msg)
+        await self._as_write(self._txmv, i)
 
     # Can raise OSError if WiFi fails. Subclass traps
     async def subscribe(self, topic, qos):
-        pkt = bytearray(b"\x82\0\0\0")
-        pid = next(self.newpid)
-        self.rcv_pids.add(pid)
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, pid)
+        topic = _b(topic)
+        pid = await self._reserve()
+        entry = self._inflight[pid]
         async with self.lock:
-            await self._as_write(pkt)
-            await self._send_str(topic)
-            await self._as_write(qos.to_bytes(1, "little"))
-
-        if not await self._await_pid(pid):
+            buf = self._txbuf_for(len(topic) + 10)
+            buf[0] = 0x82
+            i = self._put_len(buf, 1, 2 + 2 + len(topic) + 1)
+            struct.pack_into("!H", buf, i, pid)
+            i = self._put_str(buf, i + 2, topic)
+            buf[i] = qos
+            await self._as_write(self._txmv, i + 1)
+        acked = await self._await_ack(entry)
+        if self._inflight.get(pid) is entry:
+            self._release(pid, False)
+        if not acked:
             raise OSError(-1)
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .setup() method. Other (internal) MQTT
     # messages processed internally.
-    # Immediate return if no data available. Called from ._handle_msg().
+    # Sleeps until data arrives, returning after _READ_IDLE_MS if none does.
+    # Called from ._handle_msg(). Only the PUBACK reply takes self.lock, so
+    # reading never holds up publishers.
+    # The callback receives topic and msg as memoryviews into the receive
+    # buffer: they are only valid until the callback returns.
     async def wait_msg(self):
-        res = self._sock.read(1)  # Throws OSError on WiFi fail
-        if res is None:
-            return
-        if res == b'':
+        res = self._sock.readinto(self._rxmv[:1])  # Throws OSError on WiFi fail
+        if res is None:  # Nothing buffered: sleep until something arrives
+            try:
+                res = await self._stream_readinto(self._rxmv[:1], _READ_IDLE_MS)
+            except asyncio.TimeoutError:
+                return
+            if res is None:
+                return
+        if res == 0:
             raise OSError(-1)
+        self.last_rx = ticks_ms()
+        op = self._rxbuf[0]
 
-        if res == b"\xd0":  # PINGRESP
+        if op == 0xd0:  # PINGRESP
             await self._as_read(1)  # Update .last_rx time
             return
-        op = res[0]
 
         if op == 0x40:  # PUBACK: save pid
-            sz = await self._as_read(1)
-            if sz != b"\x02":
-                raise OSError(-1)
-            rcv_pid = await self._as_read(2)
-            pid = rcv_pid[0] << 8 | rcv_pid[1]
-            if pid in self.rcv_pids:
-                self.rcv_pids.discard(pid)
-            else:
+            resp = await self._as_read(3)
+            if resp[0] != 0x02:
                 raise OSError(-1)
+            pid = resp[1] << 8 | resp[2]
+            if not self._release(pid, True):
+                self.dprint('PUBACK for pid {} not in flight'.format(pid))
 
         if op == 0x90:  # SUBACK
             resp = await self._as_read(4)
             if resp[3] == 0x80:
                 raise OSError(-1)
             pid = resp[2] | (resp[1] << 8)
-            if pid in self.rcv_pids:
-                self.rcv_pids.discard(pid)
-            else:
-                raise OSError(-1)
+            if not self._release(pid, True):
+                self.dprint('SUBACK for pid {} not in flight'.format(pid))
 
         if op & 0xf0 != 0x30:
             return
         sz = await self._recv_len()
-        topic_len = await self._as_read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = await self._as_read(topic_len)
-        sz -= topic_len + 2
+        pkt = await self._as_read(sz)  # whole variable header and payload
+        topic_len = (pkt[0] << 8) | pkt[1]
+        pos = 2 + topic_len
+        topic = pkt[2:pos]
         if op & 6:
-            pid = await self._as_read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = await self._as_read(sz)
+            pid = pkt[pos] << 8 | pkt[pos + 1]
+            pos += 2
+        msg = pkt[pos:]
         retained = op & 0x01
         self._cb(topic, msg, bool(retained))
         if op & 6 == 2:  # qos 1
-            pkt = bytearray(b"\x40\x02\0\0")  # Send PUBACK
-            struct.pack_into("!H", pkt, 2, pid)
-            await self._as_write(pkt)
+            struct.pack_into("!H", self._ackpkt, 2, pid)  # Send PUBACK
+            async with self.lock:
+                await self._as_write(self._ackpkt)
         elif op & 6 == 4:  # qos 2 not supported
             raise OSError(-1)
 
@@ -520,8 +655,9 @@ class MQTTClient(MQTT_base):
             await self._connect(clean)
         except Exception:
             self.close()
+            self._in_connect = False  # else isconnected() stays True while the caller retries
             raise
-        self.rcv_pids.clear()
+        self._expire_all()
         # If we get here without error broker/LAN must be up.
         self._isconnected = True
         self._in_connect = False  # Low level code can now check connectivity.
@@ -539,17 +675,17 @@ class MQTTClient(MQTT_base):
         loop.create_task(self._connect_handler(self))  # User handler.
 
     # Launched by .connect(). Runs until connectivity fails. Checks for and
-    # handles incoming messages.
+    # handles incoming messages. A reader left over from an earlier connection
+    # exits quietly once its socket has been replaced.
     async def _handle_msg(self):
+        sock = self._sock
         try:
-            while self.isconnected():
-                async with self.lock:
-                    await self.wait_msg()  # Immediate return if no message
-                await asyncio.sleep_ms(_DEFAULT_MS)  # Let other tasks get lock
-
+            while self.isconnected() and sock is self._sock:
+                await self.wait_msg()  # Sleeps until a message arrives
         except OSError:
             pass
-        self._reconnect()  # Broker or WiFi fail.
+        if sock is self._sock:
+            self._reconnect()  # Broker or WiFi fail.
 
     # Keep broker alive MQTT spec 3.1.2.10 Keep Alive.
     # Runs until ping failure or no response in keepalive period.
@@ -589,6 +725,7 @@ class MQTTClient(MQTT_base):
         if self._isconnected:
             self._isconnected = False
             self.close()
+            self._expire_all()  # Publishers stop waiting and re-publish on reconnect
             loop = asyncio.get_event_loop()
             loop.create_task(self._wifi_handler(False))  # User handler.
 
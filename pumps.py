@@ -0,0 +1,137 @@
+# pumps.py Dosing pump scheduler for pool controller v3
+# (C) Copyright Stefan Murry 2020.
+# Released under the MIT licence.
+
+# One PumpScheduler drives each pump pin from a single task, so the pin only
+# ever sees one on and one off edge per dose.  A request that arrives while
+# the pump is running (or waiting out its minimum off time) is merged with it:
+# the pump runs until the later of the two would have finished.  Requests are
+# cut short once the day's budget of pumping seconds is used up.  Dispensed
+# seconds are added up as each dose ends, so the totals cost nothing to read.
+
+import uasyncio as asyncio
+import time
+from utime import ticks_ms, ticks_diff, ticks_add
+
+
+class PumpScheduler:
+    def __init__(self, pin, name, daily_max=0, min_off=0, notify=None):
+        self.pin = pin
+        self.name = name
+        self.daily_max = daily_max  # seconds of pumping allowed per day, 0 for no limit
+        self.min_off = min_off  # seconds the pump must rest between doses
+        self._notify = notify  # called with (name, 'on' or 'off') on each edge
+        self._pending = 0  # seconds requested but not yet started
+        self._on_at = None  # ticks_ms() the pump came on, None while off
+        self._end = 0  # ticks_ms() the running dose ends
+        self._off_at = None  # ticks_ms() the pump last went off
+        self._evt = asyncio.Event()
+        self._day = None
+        self.doses = 0
+        self.total_s = 0.0  # seconds dispensed since boot
+        self.today_s = 0.0  # seconds dispensed by completed doses today
+        pin.off()
+
+    def running(self):
+        return self._on_at is not None
+
+    def _elapsed(self):  # seconds the current dose has run
+        return ticks_diff(ticks_ms(), self._on_at) / 1000 if self._on_at is not None else 0
+
+    def _remaining(self):  # seconds still to run of the current or pending dose
+        if self._on_at is not None:
+            return max(0, ticks_diff(self._end, ticks_ms()) / 1000)
+        return self._pending
+
+    def _rollover(self):
+        day = time.time() // 86400
+        if day != self._day:
+            self._day = day
+            self.today_s = 0.0
+
+    def dispensed_today(self):
+        self._rollover()
+        return self.today_s + self._elapsed()
+
+    def budget_left(self):  # seconds that may still be requested today, None if unlimited
+        if not self.daily_max:
+            return None
+        return max(0, self.daily_max - self.dispensed_today() - self._remaining())
+
+    # Ask for the pump to run for the next `seconds`.  Returns how long it will
+    # now run for, which is less than asked if the daily budget ran out, and 0
+    # if it will not run at all.
+    def request(self, seconds):
+        rem = self._remaining()
+        extra = seconds - rem
+        if extra > 0:
+            left = self.budget_left()
+            if left is not None and extra > left:
+                extra = left
+            if self._on_at is not None:
+                self._end = ticks_add(self._end, int(extra * 1000))
+            else:
+                self._pending += extra
+            self._evt.set()
+        return max(rem, rem + extra)
+
+    # Switch off now and drop anything pending.  False if it was not running.
+    def stop(self):
+        self._pending = 0
+        was_on = self._on_at is not None
+        self._off()
+        self._evt.set()
+        return was_on
+
+    def _off(self):
+        self.pin.off()
+        if self._on_at is None:
+            return
+        ran = self._elapsed()
+        self._on_at = None
+        self._off_at = ticks_ms()
+        self._rollover()
+        self.total_s += ran
+        self.today_s += ran
+        if self._notify:
+            self._notify(self.name, 'off')
+
+    def as_dict(self):  # dose counters for the status response
+        left = self.budget_left()
+        return {'on': self.running(), 'doses': self.doses, 'total_s': round(self.total_s, 1),
+                'today_s': round(self.dispensed_today(), 1),
+                'budget_left_s': None if left is None else round(left, 1)}
+
+    async def run(self):
+        while True:
+            if not self._pending:
+                self._evt.clear()
+                await self._evt.wait()
+                continue
+            if self._off_at is not None:  # let the pump rest
+                rest = self.min_off * 1000 - ticks_diff(ticks_ms(), self._off_at)
+                if rest > 0:
+                    self._evt.clear()
+                    try:
+                        await asyncio.wait_for_ms(self._evt.wait(), rest)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue  # the request may have been stopped meanwhile
+            now = ticks_ms()
+            self._end = ticks_add(now, int(self._pending * 1000))
+            self._pending = 0
+            self._on_at = now
+            self.doses += 1
+            self.pin.on()
+            if self._notify:
+                self._notify(self.name, 'on')
+            while self._on_at is not None:  # until the end, which requests may move, or stop()
+                left = ticks_diff(self._end, ticks_ms())
+                if left <= 0:
+                    self._off()
+                    break
+                self._evt.clear()
+                try:
+                    await asyncio.wait_for_ms(self._evt.wait(), left)
+                except asyncio.TimeoutError:
+                    pass
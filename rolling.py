@@ -0,0 +1,219 @@
+# rolling.py Rolling statistics for pool controller v3
+# (C) Copyright Stefan Murry 2020.
+# Released under the MIT licence.
+
+# All storage is allocated once when the object is created.  Each new sample
+# then costs O(1) (amortised for min/max) and no heap allocation, which matters
+# on the ESP32 when the averaging windows are large.
+
+from array import array
+
+
+class RollingStats:
+    """
+    Mean, min, max, variance and exponential moving average over the
+    last `window` samples.
+    """
+    def __init__(self, window, alpha=None):
+        if window < 1:
+            raise ValueError('window must be at least 1')
+        self._w = window
+        self._buf = array('f', bytearray(4 * window))  # ring buffer of samples
+        self._n = 0  # samples currently held
+        self._i = 0  # slot the next sample goes into
+        self._seq = 0  # total samples seen, used to expire min/max candidates
+        self._ref = 0.0  # sums are kept relative to this to limit float cancellation
+        self._sum = 0.0
+        self._sq = 0.0
+        self.alpha = alpha if alpha else 2 / (window + 1)
+        self.ema = None
+        self.last = None
+        self._min = _MonoQueue(window, True)
+        self._max = _MonoQueue(window, False)
+
+    def __len__(self):
+        return self._n
+
+    def add(self, v):
+        v = float(v)
+        buf = self._buf
+        i = self._i
+        if self._n == 0:
+            self._ref = v
+        d = v - self._ref
+        if self._n == self._w:
+            old = buf[i] - self._ref
+            self._sum -= old
+            self._sq -= old * old
+        else:
+            self._n += 1
+        buf[i] = v
+        self._sum += d
+        self._sq += d * d
+        i += 1
+        if i == self._w:
+            i = 0
+            self._resync()  # once per lap, so still O(1) amortised
+        self._i = i
+        self._min.push(v, self._seq)
+        self._max.push(v, self._seq)
+        self._seq += 1
+        self.ema = v if self.ema is None else self.ema + self.alpha * (v - self.ema)
+        self.last = v
+        return self.mean
+
+    # Recompute the running sums from the buffer so rounding errors from the
+    # add/subtract updates cannot accumulate forever.
+    def _resync(self):
+        buf = self._buf
+        ref = self._ref = buf[self._w - 1]  # only called on a full lap
+        s = 0.0
+        sq = 0.0
+        for k in range(self._n):
+            d = buf[k] - ref
+            s += d
+            sq += d * d
+        self._sum = s
+        self._sq = sq
+
+    @property
+    def count(self):  # samples added since creation
+        return self._seq
+
+    @property
+    def mean(self):
+        if not self._n:
+            return None
+        return self._ref + self._sum / self._n
+
+    @property
+    def variance(self):  # population variance of the window
+        if not self._n:
+            return None
+        m = self._sum / self._n
+        var = self._sq / self._n - m * m
+        return var if var > 0 else 0.0
+
+    @property
+    def min(self):
+        return self._min.head(self._seq - self._w)
+
+    @property
+    def max(self):
+        return self._max.head(self._seq - self._w)
+
+    def as_dict(self):
+        return {'mean': self.mean, 'min': self.min, 'max': self.max,
+                'var': self.variance, 'ema': self.ema}
+
+
+class SampleFilter:
+    """
+    Robust value of the readings taken in one report cycle.  Readings outside
+    [lo, hi] (the physical range of the probe) are dropped, the rest are kept
+    sorted in a fixed array, and value() averages them after discarding the
+    `trim` lowest and highest (by default a quarter of them, and at least one,
+    so three readings give their median).  trim=(size - 1) // 2 is the median.
+    """
+    def __init__(self, size, lo, hi, trim=None):
+        self._buf = array('f', bytearray(4 * size))
+        self._size = size
+        self._n = 0
+        self.lo = lo
+        self.hi = hi
+        self.trim = max(1, size // 4) if trim is None else trim
+        self.rejected = 0
+
+    def __len__(self):
+        return self._n
+
+    def reset(self):
+        self._n = 0
+
+    def add(self, v):
+        if not self.lo <= v <= self.hi or self._n == self._size:
+            self.rejected += 1
+            return False
+        buf = self._buf
+        i = self._n
+        while i and buf[i - 1] > v:  # insertion sort, one step per reading
+            buf[i] = buf[i - 1]
+            i -= 1
+        buf[i] = v
+        self._n += 1
+        return True
+
+    def value(self):
+        n = self._n
+        if not n:
+            return None
+        t = min(self.trim, (n - 1) // 2)
+        s = 0.0
+        for i in range(t, n - t):
+            s += self._buf[i]
+        return s / (n - 2 * t)
+
+
+class OutlierGate:
+    """
+    Rejects a value further than `sigmas` standard deviations (but at least
+    `floor`) from the rolling mean of `stats`.  After `max_rejects` rejections
+    in a row the value is taken anyway, since the water itself has changed.
+    """
+    def __init__(self, stats, sigmas, floor, max_rejects=3):
+        self.stats = stats
+        self.sigmas = sigmas
+        self.floor = floor
+        self.max_rejects = max_rejects
+        self._streak = 0
+        self.rejected = 0
+
+    def accept(self, v):
+        s = self.stats
+        if not self.sigmas or len(s) < 3:
+            return True
+        d = v - s.mean
+        limit = self.sigmas * self.sigmas * max(s.variance, self.floor * self.floor)
+        if d * d <= limit or self._streak >= self.max_rejects:
+            self._streak = 0
+            return True
+        self._streak += 1
+        self.rejected += 1
+        return False
+
+
+# Monotonic queue in a fixed ring.  The head is always the current window
+# minimum (or maximum); every sample is pushed and popped at most once.
+class _MonoQueue:
+    def __init__(self, size, is_min):
+        self._vals = array('f', bytearray(4 * size))
+        self._seqs = array('I', bytearray(4 * size))
+        self._size = size
+        self._head = 0
+        self._len = 0
+        self._is_min = is_min
+
+    def push(self, v, seq):
+        size = self._size
+        vals = self._vals
+        # drop candidates from the back that can never be the answer again
+        while self._len:
+            back = (self._head + self._len - 1) % size
+            if (vals[back] >= v) if self._is_min else (vals[back] <= v):
+                self._len -= 1
+            else:
+                break
+        # the window never holds more than `size` samples, so expire the front if needed
+        if self._len and self._seqs[self._head] <= seq - size:
+            self._head = (self._head + 1) % size
+            self._len -= 1
+        slot = (self._head + self._len) % size
+        vals[slot] = v
+        self._seqs[slot] = seq
+        self._len += 1
+
+    def head(self, oldest):  # oldest: sequence number of the oldest sample still in the window
+        while self._len and self._seqs[self._head] < oldest:
+            self._head = (self._head + 1) % self._size
+            self._len -= 1
+        return self._vals[self._head] if self._len else None
@@ -1,11 +1,59 @@
 from hx711 import HX711
 from utime import sleep_us
+from array import array
+import micropython
+
+
+@micropython.native
+def _heapsort(a, n):
+    """
+    Sorts the first n items of a in place, in O(n log n) and
+    without allocating (MicroPython's array has no sort()).
+    """
+    for start in range(n // 2 - 1, -1, -1):
+        _sift(a, start, n)
+    for end in range(n - 1, 0, -1):  # move the largest left in the heap to the end
+        a[0], a[end] = a[end], a[0]
+        _sift(a, 0, end)
+
+
+@micropython.native
+def _sift(a, i, n):
+    v = a[i]
+    while True:
+        c = 2 * i + 1
+        if c >= n:
+            break
+        if c + 1 < n and a[c + 1] > a[c]:
+            c += 1
+        if a[c] <= v:
+            break
+        a[i] = a[c]
+        i = c
+    a[i] = v
+
+
+@micropython.native
+def _bisect(a, n, x, right):
+    """
+    Index of the first of the n sorted items of a that is
+    greater than x (right=True) or not less than x (right=False).
+    """
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if a[mid] < x or (right and a[mid] == x):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
 
 class Scales(HX711):
     def __init__(self, d_out, pd_sck):
         super(Scales, self).__init__(d_out, pd_sck)
         self.offset = 0
+        self._values = array('i')  # readings buffer, grown to the largest reads= used
 
     def reset(self):
         self.power_off()
@@ -17,19 +65,51 @@ class Scales(HX711):
     def raw_value(self):
         return self.read() - self.offset
 
-    def stable_value(self, reads=10, delay_us=500):
-        values = []
-        for _ in range(reads):
-            values.append(self.raw_value())
+    def _buffer(self, reads):
+        if len(self._values) < reads:
+            self._values = array('i', bytearray(4 * reads))
+        return self._values
+
+    def stable_value(self, reads=10, delay_us=500, tolerance=0):
+        values = self._buffer(reads)
+        for i in range(reads):
+            values[i] = self.raw_value()
             sleep_us(delay_us)
-        return self._stabilizer(values)
+        return self._stabilizer(values, tolerance=tolerance, n=reads)
+
+    async def stable_value_async(self, reads=10, tolerance=0):
+        """
+        stable_value() with each reading awaited, so the other tasks
+        run during the conversions.
+        """
+        values = self._buffer(reads)
+        for i in range(reads):
+            values[i] = await self.read_async() - self.offset
+        return self._stabilizer(values, tolerance=tolerance, n=reads)
 
     @staticmethod
-    def _stabilizer(values, deviation=10):
-        weights = []
-        for prev in values:
-            weights.append(sum([1 for current in values if abs(prev - current) / (prev / 100) <= deviation]))
-        return sorted(zip(values, weights), key=lambda x: x[1]).pop()[0]
+    def _stabilizer(values, deviation=10, tolerance=0, n=None):
+        """
+        The reading with the most others within `deviation` percent
+        of it (but at least `tolerance` counts, so readings near zero
+        after tare() still have neighbours).  Ties go to the reading
+        nearest the median.  Sorts the first n values in place, then
+        counts each reading's neighbours by binary search, in
+        O(n log n) instead of comparing every pair.
+        """
+        if n is None:
+            n = len(values)
+        _heapsort(values, n)
+        best, best_weight, best_dist = values[0], 0, n
+        mid = n >> 1
+        for i in range(n):
+            v = values[i]
+            tol = max(abs(v) * deviation / 100, tolerance)
+            weight = _bisect(values, n, v + tol, True) - _bisect(values, n, v - tol, False)
+            dist = abs(i - mid)
+            if weight > best_weight or (weight == best_weight and dist < best_dist):
+                best, best_weight, best_dist = v, weight, dist
+        return best
 
 
 if __name__ == "__main__":
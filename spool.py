@@ -0,0 +1,129 @@
+# spool.py Store-and-forward buffer for pool controller v3
+# (C) Copyright Stefan Murry 2020.
+# Released under the MIT licence.
+
+# Holds sensor readings taken while WiFi or the broker is down so they can be
+# replayed, oldest first, once the connection is back.  Readings are packed
+# into fixed 9 byte records (timestamp, channel, float value) in a preallocated
+# RAM ring.  If a spill file is configured, a full ring is appended to flash in
+# one write, so an outage of many hours fits in a few tens of kilobytes and
+# survives a reboot.  When the file is full too, DROP_OLDEST rewrites it
+# without its oldest records to make room, so what is kept is always the most
+# recent readings with no gap; DROP_NEWEST keeps the file and discards new
+# readings.
+
+import os
+import struct
+
+_REC = '<IBf'  # seconds since the epoch, channel number, value
+REC_SIZE = struct.calcsize(_REC)
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+
+class Spool:
+    def __init__(self, size, path=None, max_file_bytes=0, drop=DROP_OLDEST):
+        if drop not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError('drop must be {} or {}'.format(DROP_OLDEST, DROP_NEWEST))
+        self._ring = bytearray(size * REC_SIZE)
+        self._size = size
+        self._head = 0  # oldest record in the ring
+        self._len = 0  # records in the ring
+        self._path = path if max_file_bytes else None
+        self._max_file = max_file_bytes - max_file_bytes % REC_SIZE
+        self._file_pos = 0  # next unreplayed byte in the spill file
+        self._file_len = 0
+        self.drop = drop
+        self.dropped = 0
+        self._trimmed = 0  # oldest records dropped since the last peek()
+        if self._path:
+            try:
+                self._file_len = os.stat(self._path)[6]  # left over from before a reboot
+            except OSError:
+                pass
+
+    def __len__(self):
+        return self._len + (self._file_len - self._file_pos) // REC_SIZE
+
+    def append(self, ts, channel, value):
+        if self._len == self._size and not self._spill():
+            if self.drop == DROP_NEWEST:
+                self.dropped += 1
+                return False
+            self._head = (self._head + 1) % self._size  # overwrite the oldest in RAM
+            self._len -= 1
+            self.dropped += 1
+            self._trimmed += 1
+        slot = (self._head + self._len) % self._size
+        struct.pack_into(_REC, self._ring, slot * REC_SIZE, ts, channel, value)
+        self._len += 1
+        return True
+
+    # Move the whole ring to the spill file. False if there is no room for it.
+    def _spill(self):
+        if not self._path or self._len * REC_SIZE > self._max_file:
+            return False
+        room = self._max_file - self._len * REC_SIZE
+        if self._file_len > room:
+            if self.drop == DROP_NEWEST:
+                return False
+            n = max(0, self._file_len - self._file_pos - room) // REC_SIZE
+            self._file_pos += n * REC_SIZE
+            self.dropped += n
+            self._trimmed += n
+            self._compact()
+        with open(self._path, 'ab') as f:
+            tail = self._head + self._len
+            if tail <= self._size:
+                f.write(memoryview(self._ring)[self._head * REC_SIZE:tail * REC_SIZE])
+            else:
+                f.write(memoryview(self._ring)[self._head * REC_SIZE:])
+                f.write(memoryview(self._ring)[:(tail - self._size) * REC_SIZE])
+        self._file_len += self._len * REC_SIZE
+        self._head = 0
+        self._len = 0
+        return True
+
+    # Rewrite the spill file without the records before _file_pos.
+    def _compact(self):
+        tmp = self._path + '.tmp'
+        buf = bytearray(32 * REC_SIZE)
+        with open(self._path, 'rb') as src, open(tmp, 'wb') as dst:
+            src.seek(self._file_pos)
+            for _ in range(self._file_pos, self._file_len, len(buf)):
+                dst.write(memoryview(buf)[:src.readinto(buf)])
+        os.remove(self._path)
+        os.rename(tmp, self._path)
+        self._file_len -= self._file_pos
+        self._file_pos = 0
+
+    # Up to n of the oldest records as (timestamp, channel, value) tuples.
+    # They stay in the spool until commit(n) confirms they were forwarded.
+    def peek(self, n):
+        self._trimmed = 0
+        out = []
+        if self._file_pos < self._file_len:
+            with open(self._path, 'rb') as f:
+                f.seek(self._file_pos)
+                data = f.read(min(n * REC_SIZE, self._file_len - self._file_pos))
+            for i in range(0, len(data) - REC_SIZE + 1, REC_SIZE):
+                out.append(struct.unpack_from(_REC, data, i))
+            return out  # file records are all older than the ring
+        for i in range(min(n, self._len)):
+            slot = (self._head + i) % self._size
+            out.append(struct.unpack_from(_REC, self._ring, slot * REC_SIZE))
+        return out
+
+    def commit(self, n):
+        n = max(0, n - self._trimmed)  # some of those were dropped since peek()
+        self._trimmed = 0
+        if self._file_pos < self._file_len:
+            self._file_pos += n * REC_SIZE
+            if self._file_pos >= self._file_len:  # file fully replayed
+                os.remove(self._path)
+                self._file_pos = 0
+                self._file_len = 0
+            return
+        n = min(n, self._len)
+        self._head = (self._head + n) % self._size
+        self._len -= n
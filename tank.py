@@ -0,0 +1,143 @@
+# tank.py Chemical tank level for pool controller v3
+# (C) Copyright Stefan Murry 2020.
+# Released under the MIT licence.
+
+# A TankMonitor weighs the chemical tank standing on the load cell every
+# `interval` seconds.  It powers the HX711 up, awaits `reads` conversions,
+# stabilizes them with Scales and powers the HX711 down again, so the load cell
+# is only excited for about a second per weighing.  The tare offset, the scale
+# factor (counts per gram) and the learnt consumption rate are kept in a small
+# JSON file in flash so they survive a reboot.
+#
+# The level is the mean of the last `window` weighings, kept by a RollingStats
+# as each weighing arrives.  A jump of more than `refill_g` (a refill or a new
+# tank) starts the average afresh.  Consumption is learnt per second of pump
+# run time: once the pump has dispensed MIN_PUMP_S more seconds, the weight lost
+# since the last anchor point is divided by them and folded into a moving
+# average, so no history has to be kept.
+
+import json
+import uasyncio as asyncio
+from hx711 import HX711Exception
+from rolling import RollingStats
+
+MIN_PUMP_S = 60  # pump seconds between consumption rate updates
+RATE_ALPHA = 0.3  # weight of each new rate measurement
+TOLERANCE_G = 5  # readings within this many grams count as the same weight
+
+
+class TankMonitor:
+    def __init__(self, scales, pump, interval=300, reads=5, window=6, refill_g=500,
+                 path='tank.json', notify=None):
+        self.scales = scales
+        self.pump = pump  # PumpScheduler that draws from this tank
+        self.interval = interval
+        self.reads = reads
+        self.window = window
+        self.refill_g = refill_g
+        self.path = path
+        self._notify = notify  # called with the monitor after each weighing
+        self.scale = 0.0  # counts per gram, 0 until calibrated
+        self.rate = None  # grams per pump second
+        self.stats = RollingStats(window)
+        self._anchor = None  # (grams, pump seconds) the rate is measured from
+        self.lock = asyncio.Lock()
+        self.errors = 0
+        self._load()
+        scales.power_off()  # until the first weighing
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.scales.offset = saved.get('offset', 0)
+        self.scale = saved.get('scale', 0.0)
+        self.rate = saved.get('rate')
+
+    def _save(self):
+        with open(self.path, 'w') as f:
+            json.dump({'offset': self.scales.offset, 'scale': self.scale, 'rate': self.rate}, f)
+
+    async def _weigh(self):  # stabilized counts above the tare offset
+        s = self.scales
+        async with self.lock:
+            await s.power_on_async()
+            try:
+                return await s.stable_value_async(self.reads, abs(self.scale) * TOLERANCE_G)
+            finally:
+                s.power_off()
+
+    # With the tank off the scale: take the current reading as zero.
+    async def tare(self):
+        self.scales.offset += await self._weigh()
+        self._restart()
+        self._save()
+
+    # With `grams` on the scale: set counts per gram.
+    async def calibrate(self, grams):
+        counts = await self._weigh()
+        if not counts:
+            raise ValueError('no load on the scale')
+        self.scale = counts / grams
+        self._restart()
+        self._save()
+        return self.scale
+
+    def _restart(self):
+        self.stats = RollingStats(self.window)
+        self._anchor = None
+
+    @property
+    def grams(self):
+        return self.stats.mean
+
+    def _learn(self):
+        grams = self.stats.mean
+        dispensed = self.pump.total_s
+        if self._anchor is None or len(self.stats) < self.window:
+            if len(self.stats) == self.window:
+                self._anchor = (grams, dispensed)
+            return
+        g0, s0 = self._anchor
+        if dispensed - s0 < MIN_PUMP_S:
+            return
+        rate = (g0 - grams) / (dispensed - s0)
+        if rate > 0:
+            self.rate = rate if self.rate is None else self.rate + RATE_ALPHA * (rate - self.rate)
+            self._save()
+        self._anchor = (grams, dispensed)
+
+    # One weighing.  Returns the weight in grams, or None if uncalibrated.
+    async def sample(self):
+        counts = await self._weigh()
+        if not self.scale:
+            return None
+        grams = counts / self.scale
+        mean = self.stats.mean
+        if mean is not None and abs(grams - mean) > self.refill_g:
+            self._restart()
+        self.stats.add(grams)
+        self._learn()
+        return grams
+
+    def as_dict(self):
+        grams = self.grams
+        rate = self.rate
+        return {'grams': None if grams is None else round(grams),
+                'g_per_pump_s': None if rate is None else round(rate, 3),
+                'g_today': None if rate is None else round(rate * self.pump.dispensed_today()),
+                'pump_s_left': None if not rate or grams is None else int(max(grams, 0) / rate)}
+
+    async def run(self):
+        while True:
+            try:
+                await self.sample()
+            except (HX711Exception, OSError) as e:
+                self.errors += 1
+                print('tank weighing failed: {}'.format(e))
+            else:
+                if self._notify:
+                    self._notify(self)
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,89 @@
+# temperature.py DS18B20 temperature service for pool controller v3
+# (C) Copyright Stefan Murry 2020.
+# Released under the MIT licence.
+
+# A Thermometer owns the one-wire bus for the life of the program.  The bus is
+# scanned once and the ROMs kept; it is scanned again on rescan() or when a
+# probe stops answering.  Every `interval` seconds one convert_temp() starts a
+# conversion in every probe on the bus at once, the 750 ms conversion is waited
+# out with asyncio.sleep_ms rather than blocking, and each probe is read.  The
+# latest readings are kept, so callers get a temperature straight away instead
+# of waiting for a conversion.
+
+import uasyncio as asyncio
+
+CONVERSION_MS = 750  # 12 bit conversion time
+POWER_ON = 85.0  # what a probe that reset mid-conversion reads
+
+
+def _name(rom):  # ROM as hex, as used in the reports
+    return ''.join('{:02x}'.format(b) for b in rom)
+
+
+class Thermometer:
+    def __init__(self, pin, interval=60, notify=None):
+        import onewire, ds18x20
+        from machine import Pin
+        self.ds = ds18x20.DS18X20(onewire.OneWire(Pin(pin)))
+        self.interval = interval
+        self._notify = notify  # called with the thermometer after each conversion cycle
+        self.roms = []
+        self.temps = {}  # ROM name: degrees C, None while the probe does not answer
+        self.errors = 0
+        self._rescan = True
+        self._evt = asyncio.Event()  # wakes run() early
+
+    # Scan the bus again before the next conversion, e.g. after adding a probe.
+    def rescan(self):
+        self._rescan = True
+        self._evt.set()
+
+    @property
+    def value(self):  # temperature of the first probe found, None until it has been read
+        return self.temps[_name(self.roms[0])] if self.roms else None
+
+    def as_dict(self):
+        return dict(self.temps)
+
+    def _scan(self):
+        self._rescan = False
+        self.roms = self.ds.scan()
+        self.temps = {_name(rom): self.temps.get(_name(rom)) for rom in self.roms}
+        print('DS18B20 probes: {}'.format(list(self.temps)))
+
+    async def sample(self):  # one conversion cycle for every probe
+        if self._rescan:
+            self._scan()
+        if not self.roms:
+            self._rescan = True  # look again next cycle, in case one is plugged in
+            return
+        self.ds.convert_temp()
+        await asyncio.sleep_ms(CONVERSION_MS)
+        for rom in self.roms:
+            try:
+                t = self.ds.read_temp(rom)
+            except Exception:  # onewire raises plain Exception on CRC errors
+                t = None
+            if t is None or t == POWER_ON:
+                self.errors += 1
+                self._rescan = True  # unplugged or replaced
+                t = None
+            self.temps[_name(rom)] = t
+
+    async def run(self):
+        while True:
+            self._evt.clear()
+            try:
+                await self.sample()
+            except Exception as e:  # OneWireError (a plain Exception) if nothing answers the reset
+                self.errors += 1
+                self._rescan = True
+                for rom in self.temps:
+                    self.temps[rom] = None  # so nothing reports a stale reading as current
+                print('temperature read failed: {}'.format(e))
+            if self._notify:
+                self._notify(self)
+            try:
+                await asyncio.wait_for(self._evt.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass